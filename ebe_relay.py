@@ -13,53 +13,143 @@ char f (decimal 102) turns relay 2 on
 char n (decimal 110) turns both relays off (open circuit)
 char o (decimal 111) turns relay 1 off
 char p (decimal 112) turns relay 2 off
+
+The serial port is opened once and kept open, shared by all the relays on the board behind a
+lock. A read that gets no answer is retried a few times (READ_RETRIES) before giving up with a
+RelayBoardError, rather than waiting for the board forever.
+
+set_relays({1: 1, 2: 0}) switches both relays with the fewest commands and reads both back from
+the one status byte, in a single round trip; read_relays() reads both.
 """
 
 
 import argparse
 import sys
+import threading
 import serial
 
-import binascii
-
 # back hal realy is number 1, main hall number 2
 RELAY = 1
+DEVICE = '/dev/ttyACM0'
+
+# seconds to wait for the board's answer, and how many times to ask
+READ_TIMEOUT = 0.5
+READ_RETRIES = 8
+
+COMMANDS = {1: (b'e', b'o'), 2: (b'f', b'p')}  # relay -> (on, off)
+ALL = (b'd', b'n')  # both relays (on, off)
+
+
+class RelayBoardError(IOError):
+  """the relay board did not answer"""
+
+
+class Connection:
+  """the serial connection to a relay board, opened on first use and kept open"""
+
+  def __init__(self, dev=DEVICE, timeout=READ_TIMEOUT, retries=READ_RETRIES):
+    self.dev = dev
+    self.timeout = timeout
+    self.retries = retries
+    self.ser = None
+    self.lock = threading.RLock()
+
+  def port(self):
+    """the open serial port, opening it if needed"""
+    if self.ser is None:
+      self.ser = serial.Serial(self.dev, timeout=self.timeout)
+    return self.ser
+
+  def status(self, command=b''):
+    """send command (bytes) followed by '[' and return the status byte the board answers"""
+    with self.lock:
+      try:
+        ser = self.port()
+        ser.reset_input_buffer()  # late answers to an earlier '['
+        ser.write(command + b'[')
+        for attempt in range(self.retries):
+          r = ser.read(1)
+          if r:
+            return r[0]
+          ser.write(b'[')
+      except serial.SerialException:
+        self.close()
+        raise
+      raise RelayBoardError('no answer from the relay board on {0} after {1} tries'.format(self.dev, self.retries))
+
+  def close(self):
+    with self.lock:
+      if self.ser is not None:
+        self.ser.close()
+        self.ser = None
+
+
+_connections = {}  # dev -> its Connection
+_connections_lock = threading.Lock()
+
+
+def connection(dev=DEVICE):
+  """the shared Connection of the board on dev"""
+  with _connections_lock:
+    if dev not in _connections:
+      _connections[dev] = Connection(dev)
+    return _connections[dev]
+
+
+def close(release=False):
+  """close the serial ports. The relays keep their positions"""
+  with _connections_lock:
+    for conn in _connections.values():
+      conn.close()
+    _connections.clear()
+
+
+def rd(pin, status):
+  """the position of relay pin in a status byte"""
+  return (status >> (pin - 1)) & 1
+
+
+def closed(position):
+  """1 for a position that closes the relay (1, True or 'closed'), 0 for one that opens it, None if unknown"""
+  if (position == True or position == 'closed' or (position != 'open' and int(position) == 1)):
+    return 1
+  elif(position == False or position == 'open' or int(position) == 0):
+    return 0
+  print('unknown position {}'.format(position))
+  return None
+
+
+def commands(positions):
+  """the fewest commands to switch the relays to positions, {relay: 1 or 0}
+
+  >>> commands({1: 1, 2: 1}), commands({1: 1, 2: 0}), commands({2: 0})
+  (b'd', b'ep', b'p')
+  """
+  if set(positions) == set(COMMANDS) and len(set(positions.values())) == 1:
+    return ALL[0] if list(positions.values())[0] else ALL[1]
+  return b''.join(COMMANDS[pin][0] if position else COMMANDS[pin][1] for pin, position in sorted(positions.items()))
+
+
+def set_relays(positions, dev=DEVICE):
+  """switch the relays to positions, {relay: position}, returning all their positions {relay: 1 or 0}"""
+  positions = {pin: closed(position) for pin, position in positions.items()}
+  status = connection(dev).status(commands({pin: p for pin, p in positions.items() if p is not None}))
+  return {pin: rd(pin, status) for pin in COMMANDS}
+
 
-def rd(pin, ser):
-  while True :
-    ser.write('[')
-    r=ser.read()
-    if r != '' :
-      break
-  return (int(binascii.hexlify(r)) & pin)>>(pin-1)
+def read_relays(dev=DEVICE):
+  """the positions of all the relays, {relay: 1 or 0}"""
+  status = connection(dev).status()
+  return {pin: rd(pin, status) for pin in COMMANDS}
 
 
-def relay(dev='/dev/ttyACM0',
+def relay(dev=DEVICE,
           position='not_defined',
           pin=RELAY):
 
-  # relay choises
-  if (pin == 1):
-    on  = 'e'
-    off = 'o'
-  elif(pin == 2):
-    on  = 'f'
-    off = 'p'
-    
-  # open serial connection
-  ser = serial.Serial(dev, timeout = 4)
-  # dummy read
-  rd(pin, ser)
-
-  #
   if (position != 'not_defined'):
-    if (position == True or position == 'closed' or int(position) == 1):
-      ser.write(on)
-    elif(position == False or position == 'open' or int(position) == 0):
-      ser.write(off)
-    else:
-      print('unknown position {}'.format(position))
-  return rd(pin, ser)
+    return set_relays({pin: position}, dev)[pin]
+  return read_relays(dev)[pin]
 
 if __name__ == "__main__":
 
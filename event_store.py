@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""Locally saved calendar events, keyed by event id.
+
+Merging a sync into the saved events used to scan the whole list for every new event, which gets
+slow once recurring events are expanded into thousands of instances. The store looks events up by
+id instead, and keeps them in the order they were first seen.
+
+Only what the relay needs is kept of each event: its id and its start and end as seconds since the
+epoch, worked out once when the event arrives rather than parsed again on every run. The settings
+file saves each event as a compact [id, start, end] list. Settings files from before, holding the
+events as google sent them, load as well.
+
+All-day events have dates rather than times: they start and end at the midnights of those dates in
+the calendar's timezone (or the local one until google has said what that is), and from then on
+are events like any other.
+"""
+
+import datetime
+import heapq
+import logging
+
+import dateutil.parser
+from dateutil.tz import gettz
+
+logger = logging.getLogger(__name__)
+
+# looked up once, used for the midnights of all-day events when the calendar's timezone is not known
+LOCAL_TZ = gettz()
+
+
+class Event:
+    """
+  An event as the relay needs it: id, start and end in seconds since the epoch, and whether it is all-day
+
+  >>> e = Event.from_api({u'id': u'1', u'status': u'confirmed', u'summary': u'heat', u'start': {u'dateTime': u'2014-12-07T21:00:00+01:00'}, u'end': {u'dateTime': u'2014-12-07T22:00:00+01:00'}})
+  >>> e
+  Event('1', 1417982400, 1417986000)
+  >>> Event.from_json(e.to_json()) == e
+  True
+  """
+
+    __slots__ = ('id', 'start', 'end', 'all_day')
+
+    def __init__(self, id, start, end, all_day=False):
+        self.id = id
+        self.start = start
+        self.end = end
+        self.all_day = all_day
+
+    @classmethod
+    def from_api(cls, event, tz=None):
+        """the Event of a google calendar event (json). The dates of all-day events are taken in timezone tz"""
+        all_day = 'dateTime' not in event['start']
+        return cls(event[u'id'], event_time(event['start'], tz), event_time(event['end'], tz), all_day)
+
+    @classmethod
+    def from_json(cls, saved):
+        """the Event saved as [id, start, end] or [id, start, end, 1] for an all-day event"""
+        return cls(saved[0], saved[1], saved[2], bool(saved[3]) if len(saved) > 3 else False)
+
+    def to_json(self):
+        if self.all_day:
+            return [self.id, self.start, self.end, 1]
+        return [self.id, self.start, self.end]
+
+    def __eq__(self, other):
+        return isinstance(other, Event) and self.to_json() == other.to_json()
+
+    def __repr__(self):
+        return 'Event({0!r}, {1}, {2}{3})'.format(self.id, self.start, self.end, ', all_day=True' if self.all_day else '')
+
+
+def event_time(when, tz=None):
+    """seconds since the epoch of the start or end ({'dateTime': ...} or {'date': ...}) of a google calendar event"""
+    if 'dateTime' in when:
+        return int(dateutil.parser.isoparse(when['dateTime']).timestamp())
+    date = dateutil.parser.isoparse(when['date'])
+    return int(date.replace(tzinfo=tz or LOCAL_TZ).timestamp())
+
+
+def move_day(t, old_tz, new_tz):
+    """
+  the midnight t starting a day in timezone old_tz, as the midnight starting the same day in new_tz
+
+  >>> move_day(1417910400, gettz('UTC'), gettz('Europe/Paris'))
+  1417906800
+  """
+    day = datetime.datetime.fromtimestamp(t, old_tz).replace(tzinfo=None)
+    return int(day.replace(tzinfo=new_tz).timestamp())
+
+
+class EventStore:
+    """
+  Calendar events keyed by id, with O(1) upsert and delete, iterating in the order they were added.
+  Cancelled events are deleted rather than stored. A min-heap of the events by end time finds
+  the ones that are over without looking at the others.
+
+  >>> store = EventStore([[u'1', 100, 200]])
+  >>> store.merge([{u'id': u'2', u'status': u'confirmed', u'start': {u'dateTime': u'1970-01-01T00:05:00Z'}, u'end': {u'dateTime': u'1970-01-01T00:06:00Z'}}])
+  1
+  >>> store.to_json()
+  [['1', 100, 200], ['2', 300, 360]]
+  >>> store.merge([{u'id': u'1', u'status': u'cancelled'}])
+  1
+  >>> [event.id for event in store]
+  ['2']
+  """
+
+    def __init__(self, events=(), tz=None):
+        self._events = {}
+        self.tz = tz
+        self.version = 0  # incremented on every change, so anything built from the events knows to rebuild
+        self._changed = set()  # ids added or replaced, and deleted, since take_changes()
+        self._deleted = set()
+        self._ends = []  # heap of (end, id), with stale entries for replaced or deleted events left in
+        self.on_change = None  # called with the old and new Event (either None) after each change
+        for event in events:
+            if isinstance(event, list):
+                self.upsert(Event.from_json(event))
+            else:
+                self.upsert(event)
+
+    def __iter__(self):
+        return iter(list(self._events.values()))
+
+    def __len__(self):
+        return len(self._events)
+
+    def __contains__(self, event_id):
+        return event_id in self._events
+
+    def get(self, event_id, default=None):
+        return self._events.get(event_id, default)
+
+    def upsert(self, event):
+        """add or replace an Event, or a google calendar event (json) which is deleted if it has been cancelled"""
+        if not isinstance(event, Event):
+            if event.get(u'status') == u'cancelled':
+                self.discard(event[u'id'])
+                return
+            try:
+                event = Event.from_api(event, self.tz)
+            except (KeyError, ValueError):
+                logger.warning('skipping event {0}: no start or end time'.format(event.get(u'id')))
+                return
+        old = self._events.get(event.id)
+        if old == event:
+            return  # nothing that matters to the relay has changed
+        self._events[event.id] = event
+        heapq.heappush(self._ends, (event.end, event.id))
+        self._changed.add(event.id)
+        self._deleted.discard(event.id)
+        self.version += 1
+        if self.on_change:
+            self.on_change(old, event)
+
+    def set_tz(self, tz):
+        """take the dates of all-day events in timezone tz, moving the saved ones to its midnights"""
+        old_tz, new_tz = self.tz or LOCAL_TZ, tz or LOCAL_TZ
+        self.tz = tz
+        for event in self:
+            if event.all_day:
+                self.upsert(Event(event.id, move_day(event.start, old_tz, new_tz),
+                                  move_day(event.end, old_tz, new_tz), all_day=True))
+
+    def discard(self, event_id):
+        """delete an event if it is there"""
+        if event_id in self._events:
+            self.remove(self._events[event_id])
+
+    def remove(self, event):
+        """delete an event, as list.remove would"""
+        del self._events[event.id]
+        self._deleted.add(event.id)
+        self._changed.discard(event.id)
+        self.version += 1
+        if len(self._ends) > 2 * len(self._events) + 64:
+            self._ends = [(e.end, e.id) for e in self._events.values()]
+            heapq.heapify(self._ends)
+        if self.on_change:
+            self.on_change(event, None)
+
+    def expire(self, before):
+        """
+    delete the events that ended before `before` (seconds since the epoch), all-day ones included,
+    and return them. Only the expired events and stale heap entries are looked at.
+
+    >>> store = EventStore([[u'1', 100, 200], [u'2', 100, 400], [u'3', 300, 350]])
+    >>> store.expire(360)
+    [Event('1', 100, 200), Event('3', 300, 350)]
+    >>> store.to_json()
+    [['2', 100, 400]]
+    """
+        expired = []
+        while self._ends and self._ends[0][0] < before:
+            end, event_id = heapq.heappop(self._ends)
+            event = self._events.get(event_id)
+            if event is not None and event.end == end:
+                self.remove(event)
+                expired.append(event)
+        return expired
+
+    def take_changes(self):
+        """the Events added or replaced and the ids deleted since the last call"""
+        changed = [self._events[event_id] for event_id in self._changed]
+        deleted = list(self._deleted)
+        self._changed.clear()
+        self._deleted.clear()
+        return changed, deleted
+
+    def merge(self, new_events):
+        """upsert each of new_events, returning how many there were"""
+        count = 0
+        for event in new_events or ():
+            self.upsert(event)
+            count += 1
+        return count
+
+    def to_json(self):
+        """the events as the list saved in the settings file"""
+        return [event.to_json() for event in self._events.values()]
+
+
+def settings_default(obj):
+    """`default` for json.dump, to save the event stores (and anything else with a to_json) within the settings"""
+    if hasattr(obj, 'to_json'):
+        return obj.to_json()
+    raise TypeError('Object of type {0} is not JSON serializable'.format(type(obj).__name__))
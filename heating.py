@@ -10,33 +10,60 @@
 """Command-line synchronisation application between Google Calendar and Linux's Crontab.
 Usage:
   $ python gcalcron2.py
+
+The google api client libraries take seconds to import on a Pi Zero, so they are only imported
+when the calendar is synced, after the relay has been switched from the saved events. Run with
+--startup_report to see where the time goes.
 """
 
-# Google API
+import time
+_started = time.perf_counter()  # for the --startup_report
+
 import argparse
-import httplib2
+import contextlib
 import os
 import sys
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-from relay import relay
+from relay_backends import get_backend, close_all as close_relays
+from event_store import EventStore, LOCAL_TZ
+from timeline import Timeline, to_datetime
+from state_store import open_state, write_atomic
+from recurrence import RecurringEvents
+from poll_scheduler import PollScheduler
+from token_manager import TokenManager
+from transport_policy import CircuitBreaker, CircuitOpenError, TransportPolicy, http_status, is_transient
 
 # GCalCron
 import json
 import datetime
-from datetime import timezone
 import dateutil.parser
+import dateutil.tz
 from dateutil.tz import gettz
-import time
-import subprocess
-import re
+import itertools
+import queue
+import signal
+import threading
 import logging
 
 logger = logging.getLogger(__name__)
 
+# what took how long since startup, (what, seconds) in the order it happened
+STARTUP_TIMES = [('import heating.py', time.perf_counter() - _started)]
+
+
+@contextlib.contextmanager
+def timed(what):
+    """note in STARTUP_TIMES how long the block took"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STARTUP_TIMES.append((what, time.perf_counter() - start))
+
+
+def startup_report():
+    """STARTUP_TIMES as one line for the log"""
+    return 'startup: ' + ', '.join('{0} {1:.2f}s'.format(what, seconds) for what, seconds in STARTUP_TIMES)
+
 # Parser for command-line arguments.
 parser = argparse.ArgumentParser(
     description=__doc__,
@@ -45,10 +72,51 @@ parser = argparse.ArgumentParser(
 parser.add_argument('--reset', default=False,
                     help='Reset all synchronised events')
 parser.add_argument('-s', '--settings_file', default='.heating',
-                    help='Name of settings file in home folder. change this for multiple instances')
+                    help='Name of settings file in home folder. change this for multiple instances. '
+                         'Ending in .db or .sqlite, it is an SQLite database rather than a JSON file')
+parser.add_argument('-d', '--daemon', action='store_true', default=False,
+                    help='Stay resident and wake at the next relay transition or sync deadline, instead of '
+                         'being run from cron every minute')
+parser.add_argument('-i', '--interval', type=int, default=60,
+                    help='Seconds between Google Calendar syncs in daemon mode')
+parser.add_argument('--evaluate_interval', type=int, default=60,
+                    help='Most seconds between relay updates from the saved events in daemon mode (besides those '
+                         'at the start and end of each event)')
+parser.add_argument('--sync_timeout', type=int, default=60,
+                    help='Seconds for each request to Google Calendar before giving up on it')
+parser.add_argument('--token_file', default=None,
+                    help='File the google credentials are kept in, shared by all the processes. By default token.json '
+                         'next to heating.py')
+parser.add_argument('--push_address', default=None,
+                    help='Public https url of this daemon\'s /notifications web hook. Google then notifies the daemon '
+                         'of calendar changes, so --interval can be much longer')
+parser.add_argument('--push_port', type=int, default=8081,
+                    help='Port to receive the push notifications on (8080 is taken by the google login)')
+parser.add_argument('--push_token', default=None,
+                    help='Secret that push notifications must carry, a random one if not given')
+parser.add_argument('--startup_report', action='store_true', default=False,
+                    help='Log how long the imports, loading the settings, the first relay decision and the sync took')
+parser.add_argument('--schedule', default=None,
+                    help='Write the relay plan for the coming week, from the saved events, as CSV to this file '
+                         '(- for stdout) instead of syncing')
 
 SCOPES = ['https://www.googleapis.com/auth/calendar.readonly']
 
+# the google credentials, shared by all the runs of heating.py, see token_manager.py
+TOKEN_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'token.json')
+
+# the calendar API discovery document is kept here, so that building the service never needs the network
+DISCOVERY_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.calendar_v3_discovery.json')
+_discovery_document = None
+
+# how many days ahead events are synced (and recurring events expanded, when that is done locally), unless the
+# settings ask for "days_ahead"
+DAYS_AHEAD = 7
+
+# how long a sync token is used for before starting again with a full sync. The full sync fetches this much further
+# ahead than num_days, so that events coming into the num_days horizon meanwhile are already known
+SYNC_TOKEN_LIFETIME = datetime.timedelta(days=1)
+
 
 class GCalAdapter:
     """
@@ -65,45 +133,56 @@ class GCalAdapter:
     def __init__(self, calendarId=None, flags=None):
         self.calendarId = calendarId
         self.service = None
+        self.single_events = True  # False to get recurring events as such, see recurrence.py
+        self.time_zones = {}  # calendarId -> the calendar's timezone, as the last query returned it
+        # seconds for each request to google before giving up, None to wait as long as it takes
+        self.timeout = getattr(flags, 'sync_timeout', None)
+        self.transport = TransportPolicy()  # retries, and the circuit breaker
         self.flags = flags
+        self.tokens = TokenManager(getattr(flags, 'token_file', None) or TOKEN_FILE, SCOPES, old_path='token.json')
         self.creds = None
-        if os.path.exists('token.json'):
-            self.creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-
-    @staticmethod
-    def _assure_refreshed(credentials: Credentials):
-        if not credentials.valid and credentials.expired and credentials.refresh_token:
-            credentials.refresh(Request())
-        return credentials
 
     def get_service(self):
-
-        # If there are no (valid) credentials available, let the user log in.
-        if not self.creds or not self.creds.valid:
-            if self.creds and self.creds.expired and self.creds.refresh_token:
-                self._assure_refreshed(self.creds)
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    'client_secrets.json', SCOPES)
-                self.creds = flow.run_local_server(host='localhost', port=8080)
-                # Save the credentials for the next run
-            with open('token.json', 'w') as token:
-                token.write(self.creds.to_json())
-
-        try:
-            self.service = build('calendar', 'v3', credentials=self.creds)
-        except HttpError as error:
-            print("An Error occured: %s" % error)
+        from googleapiclient.errors import HttpError
+
+        # the credentials, refreshed ahead of expiry. If there are none (or they cannot be renewed), let the user log in
+        with timed('load google credentials') if self.creds is None else contextlib.nullcontext():
+            self.creds = self.tokens.credentials()
+        if self.creds is None:
+            from google_auth_oauthlib.flow import InstalledAppFlow
+            flow = InstalledAppFlow.from_client_secrets_file(self.CLIENT_SECRETS, SCOPES)
+            self.creds = flow.run_local_server(host='localhost', port=8080)
+            self.tokens.save(self.creds)
+            self.service = None  # built with the old credentials
+
+        # the service is built once per process, refreshing the credentials in place keeps it usable
+        if self.service is None:
+            with timed('import google api client'):
+                from googleapiclient.discovery import build_from_document
+            try:
+                if self.timeout:
+                    import httplib2
+                    from google_auth_httplib2 import AuthorizedHttp
+                    http = AuthorizedHttp(self.creds, http=httplib2.Http(timeout=self.timeout))
+                    self.service = build_from_document(discovery_document(), http=http)
+                else:
+                    self.service = build_from_document(discovery_document(), credentials=self.creds)
+            except HttpError as error:
+                print("An Error occured: %s" % error)
 
         return self.service
 
-    def get_query(self, start_min, start_max, updated_min=None):
+    def recurrence_fields(self):
+        """the extra event fields needed to expand recurring events locally, when google doesn't"""
+        return '' if self.single_events else ',recurrence,recurringEventId,originalStartTime'
+
+    def get_query(self, start_min, start_max, updated_min=None, calendarId=None):
         """
     Builds the Google Calendar query with default options set
 
     >>> g = GCalAdapter()
     >>> g.get_query(datetime.datetime(2011, 6, 19, 14, 0), datetime.datetime(2011, 6, 26, 14, 0), datetime.datetime(2011, 6, 18, 14, 0))
-    {'orderBy': 'updated', 'showDeleted': True, 'calendarId': None, 'timeMin': '2011-06-19T14:00:00', 'updatedMin': '2011-06-18T14:00:00', 'timeMax': '2011-06-26T14:00:00', 'fields': 'items(description,end,id,start,status,summary,updated)', 'singleEvents': True, 'maxResults': 1000}
+    {'calendarId': None, 'maxResults': 1000, 'orderBy': 'updated', 'showDeleted': True, 'singleEvents': True, 'fields': 'items(description,end,id,start,status,summary,updated),timeZone', 'timeMin': '2011-06-19T14:00:00', 'timeMax': '2011-06-26T14:00:00', 'updatedMin': '2011-06-18T14:00:00'}
 
     @author Fabrice Bernhard
     @since 2011-06-19
@@ -113,12 +192,13 @@ class GCalAdapter:
         start_min.isoformat(), start_max.isoformat(), updated_min))
 
         query = {
-            'calendarId': self.calendarId,
+            'calendarId': calendarId or self.calendarId,
             'maxResults': 1000,
             'orderBy': 'updated',
             'showDeleted': True,
-            'singleEvents': True,
-            'fields': 'items(description,end,id,start,status,summary,updated)',
+            'singleEvents': self.single_events,
+            'fields': 'items(description,end,id,start,status,summary,updated{0}),timeZone'.format(
+                self.recurrence_fields()),
             'timeMin': start_min.isoformat(),
             'timeMax': start_max.isoformat(),
         }
@@ -128,18 +208,26 @@ class GCalAdapter:
 
         return query
 
+    def note_time_zone(self, query, response):
+        """remember the timezone of the queried calendar, in which its all-day events are"""
+        if response.get('timeZone'):
+            self.time_zones[query['calendarId']] = response['timeZone']
+
     def queryApi(self, queries):
         """Query the Google Calendar API."""
 
         logger.info('Submitting query')
 
+        self.transport.check()
+        service = self.get_service()
         entries = []
         for query in queries:
             pageToken = None
             while True:
                 query['pageToken'] = pageToken
-                gCalEvents = self.get_service().events().list(**query).execute()
+                gCalEvents = self.transport.execute(service.events().list(**query))
                 entries += gCalEvents['items']
+                self.note_time_zone(query, gCalEvents)
                 pageToken = gCalEvents.get('nextPageToken')
                 if not pageToken:
                     break
@@ -149,27 +237,246 @@ class GCalAdapter:
 
         return entries
 
-    def get_events(self, sync_start, last_sync=None, num_days=datetime.timedelta(days=7)):
+    def querySync(self, query):
+        """Query the Google Calendar API with a sync query, returning the entries and the next sync token."""
+
+        logger.info('Submitting sync query')
+
+        self.transport.check()
+        service = self.get_service()
+        entries = []
+        while True:
+            gCalEvents = self.transport.execute(service.events().list(**query))
+            entries += gCalEvents['items']
+            self.note_time_zone(query, gCalEvents)
+            if not gCalEvents.get('nextPageToken'):
+                break
+            query = dict(query, pageToken=gCalEvents['nextPageToken'])
+
+        logger.info('Query results received')
+        logger.debug(entries)
+
+        return entries, gCalEvents.get('nextSyncToken')
+
+    def queryApiBatch(self, zone_queries, batch_size=50, resync=None):
+        """Query the Google Calendar API for several zones at once.
+
+    All the queries go out through the batch endpoint over the one authorised connection of the service,
+    following up any further pages, and retrying the queries google was too busy for, in the next batch.
+    Returns one (entries, next sync token, resynced) tuple per list of queries, or None for a zone whose query failed.
+    If a zone's sync token has expired, `resync(zone)` gives the full sync query to run instead, and resynced is True.
+    """
+
+        logger.info('Submitting batch of %d queries' % sum(len(queries) for queries in zone_queries))
+
+        self.transport.check()
+        service = self.get_service()
+        results = [([], None, False) for _ in zone_queries]
+        pending = [(zone, query) for zone, queries in enumerate(zone_queries) for query in queries]
+        retries = [0 for _ in zone_queries]
+        waits = []  # before the next batch, for the queries to retry
+        answered = []  # the zones google answered a query of
+        failed = []  # the zones given up on after transient errors
+        while pending:
+            if waits:
+                self.transport.sleep(max(waits))
+                waits.clear()
+            batch, pending = pending[:batch_size], pending[batch_size:]
+            request = service.new_batch_http_request()
+            for zone, query in batch:
+                def callback(request_id, response, exception, zone=zone, query=query):
+                    if results[zone] is None:
+                        return
+                    if exception is not None:
+                        wait = None
+                        if is_transient(exception) and retries[zone] < self.transport.retries:
+                            wait = self.transport.delay(retries[zone], exception)
+                        if resync and 'syncToken' in query and http_status(exception) == 410:
+                            logger.warning('sync token for %s expired - falling back to a full sync' % query['calendarId'])
+                            results[zone] = ([], None, True)
+                            pending.append((zone, resync(zone)))
+                        elif wait is not None:
+                            logger.warning('query for %s failed: %s - retrying' % (query['calendarId'], exception))
+                            retries[zone] += 1
+                            waits.append(wait)
+                            pending.append((zone, query))
+                        else:
+                            logger.error('query for %s failed: %s' % (query['calendarId'], exception))
+                            results[zone] = None
+                            if is_transient(exception):
+                                failed.append(zone)
+                        return
+                    answered.append(zone)
+                    results[zone][0].extend(response['items'])
+                    self.note_time_zone(query, response)
+                    if response.get('nextPageToken'):
+                        pending.append((zone, dict(query, pageToken=response['nextPageToken'])))
+                    elif response.get('nextSyncToken'):
+                        results[zone] = (results[zone][0], response['nextSyncToken'], results[zone][2])
+
+                request.add(service.events().list(**query), callback=callback)
+            self.transport.execute(request, batch=True)
+        # the breaker counts failed syncs, so a batch counts once however many of its zones failed
+        if answered:
+            self.transport.breaker.succeeded()
+        elif failed:
+            self.transport.breaker.failed()
+
+        logger.info('Query results received')
+        logger.debug(results)
+
+        return results
+
+    def get_sync_query(self, sync_start, sync_token=None, num_days=datetime.timedelta(days=7), calendarId=None):
         """
-    Gets a list of events to sync
+    Builds the query for the changes since sync_token, or without one, for the full sync that starts
+    the next sync token. The full sync runs from sync_start to sync_start + num_days + SYNC_TOKEN_LIFETIME.
+    """
+
+        query = {
+            'calendarId': calendarId or self.calendarId,
+            'maxResults': 1000,
+            'showDeleted': True,
+            'singleEvents': self.single_events,
+            'fields': 'items(description,end,id,start,status,summary,updated{0}),nextPageToken,nextSyncToken,timeZone'.format(
+                self.recurrence_fields()),
+        }
+
+        if sync_token:
+            logger.info('Setting up incremental query from sync token')
+            query['syncToken'] = sync_token
+        else:
+            start_max = sync_start + num_days + SYNC_TOKEN_LIFETIME
+            logger.info('Setting up full sync query: %s to %s' % (sync_start.isoformat(), start_max.isoformat()))
+            query['timeMin'] = sync_start.isoformat()
+            query['timeMax'] = start_max.isoformat()
+
+        return query
+
+    def get_queries(self, sync_start, last_sync=None, num_days=datetime.timedelta(days=7), calendarId=None):
+        """
+    Builds the queries for the events to sync
      - events between sync_start and last_sync + num_days which have been updated since last_sync
      - new events between last_sync + num_days and sync_start + num_days
-    @author Fabrice Bernhard
-    @since 2011-06-13
     """
 
         queries = []
         end = sync_start + num_days
         if last_sync:
             # query all events modified since last synchronisation
-            queries.append(self.get_query(sync_start - datetime.timedelta(hours=1), last_sync + num_days, last_sync))
+            queries.append(self.get_query(sync_start - datetime.timedelta(hours=1), last_sync + num_days, last_sync,
+                                          calendarId))
             # query all events which appeared in the [last_sync + num_days, sync_start + num_days] time frame
             queries.append(self.get_query(last_sync + num_days,
-                                          end))  # TODO: only do this every few hours... log gets filled with updates, job numbers keep incrementing
+                                          end, calendarId=calendarId))  # TODO: only do this every few hours... log gets filled with updates, job numbers keep incrementing
         else:
-            queries.append(self.get_query(sync_start, end))
+            queries.append(self.get_query(sync_start, end, calendarId=calendarId))
+
+        return queries
+
+    def get_events(self, sync_start, last_sync=None, num_days=datetime.timedelta(days=7)):
+        """
+    Gets a list of events to sync
+     - events between sync_start and last_sync + num_days which have been updated since last_sync
+     - new events between last_sync + num_days and sync_start + num_days
+    @author Fabrice Bernhard
+    @since 2011-06-13
+    """
+
+        return self.queryApi(self.get_queries(sync_start, last_sync, num_days))
+
+    def get_zone_events(self, zones, num_days=datetime.timedelta(days=7)):
+        """
+    Gets the events to sync for several calendars in one batched request
+
+    Arguments:
+    - `zones`: list of (calendarId, sync_start, last_sync) tuples
+    - `num_days`: how far ahead to sync
+    """
+
+        results = self.queryApiBatch([self.get_queries(sync_start, last_sync, num_days, calendarId)
+                                      for calendarId, sync_start, last_sync in zones])
+        return [result[0] if result else None for result in results]
+
+    def get_changes(self, sync_start, sync_token=None, num_days=datetime.timedelta(days=7)):
+        """
+    Gets the events changed since sync_token, the next sync token, and whether that was a full sync.
+    Without a sync token, or when google has expired it (410 Gone), this is a full sync instead.
+    """
+        from googleapiclient.errors import HttpError
+
+        try:
+            entries, next_sync_token = self.querySync(self.get_sync_query(sync_start, sync_token, num_days))
+            return entries, next_sync_token, sync_token is None
+        except HttpError as error:
+            if not sync_token or http_status(error) != 410:
+                raise
+            logger.warning('sync token expired - falling back to a full sync')
+        entries, next_sync_token = self.querySync(self.get_sync_query(sync_start, None, num_days))
+        return entries, next_sync_token, True
+
+    def get_zone_changes(self, zones, num_days=datetime.timedelta(days=7)):
+        """
+    Gets the events changed since their sync tokens for several calendars in one batched request
+
+    Arguments:
+    - `zones`: list of (calendarId, sync_start, sync_token) tuples
+    - `num_days`: how far ahead to sync
+    Returns one (events, next sync token, full sync) tuple per zone, or None for a zone whose query failed
+    """
+
+        results = self.queryApiBatch([[self.get_sync_query(sync_start, sync_token, num_days, calendarId)]
+                                      for calendarId, sync_start, sync_token in zones],
+                                     resync=lambda zone: self.get_sync_query(zones[zone][1], None, num_days,
+                                                                             zones[zone][0]))
+        return [result and (result[0], result[1], result[2] or sync_token is None)
+                for (calendarId, sync_start, sync_token), result in zip(zones, results)]
+
+
+    def watch(self, channel_id, address, token, ttl, calendarId=None):
+        """open a push notification channel (events.watch) for the calendar's events"""
+        body = {
+            'id': channel_id,
+            'type': 'web_hook',
+            'address': address,
+            'token': token,
+            'params': {'ttl': str(int(ttl.total_seconds()))},
+        }
+        return self.get_service().events().watch(calendarId=calendarId or self.calendarId, body=body).execute()
+
+    def stop_watch(self, channel_id, resource_id):
+        """close a push notification channel"""
+        self.get_service().channels().stop(body={'id': channel_id, 'resourceId': resource_id}).execute()
+
 
-        return self.queryApi(queries)
+def discovery_document():
+    """
+  The calendar v3 discovery document, parsed once per process. It is read from DISCOVERY_CACHE, which is filled
+  on first use from the copy bundled with googleapiclient or, failing that, from google.
+  """
+    global _discovery_document
+    if _discovery_document is None:
+        try:
+            with open(DISCOVERY_CACHE) as f:
+                _discovery_document = json.load(f)
+        except (IOError, ValueError):
+            import httplib2
+            from googleapiclient.discovery import DISCOVERY_URI
+            from googleapiclient.discovery_cache import get_static_doc
+            from googleapiclient.errors import HttpError
+            document = get_static_doc('calendar', 'v3')
+            if document is None:
+                logger.info('fetching the calendar API discovery document')
+                response, document = httplib2.Http().request(
+                    DISCOVERY_URI.replace('{api}', 'calendar').replace('{apiVersion}', 'v3'))
+                if response.status >= 400:
+                    raise HttpError(response, document)
+            _discovery_document = json.loads(document)
+            try:
+                write_atomic(DISCOVERY_CACHE, json.dumps(_discovery_document))
+            except IOError:
+                logger.warning('could not cache the discovery document in {0}'.format(DISCOVERY_CACHE))
+    return _discovery_document
 
 
 class GCalCron:
@@ -183,23 +490,40 @@ class GCalCron:
   """
 
     settings = None
-
-    def __init__(self, gCalAdapter=None, flags=None, settings=None):
-        if settings:
+    state = None
+    controller = None
+    _timeline = None
+    _timeline_version = None
+    _commanded = None  # the position the relay was last switched to (or read) by this process
+
+    def __init__(self, gCalAdapter=None, flags=None, settings=None, zone=None, controller=None):
+        if zone is not None:
+            # one of the zones of a ZoneController, which owns the settings file
+            self.settings = zone
+            self.controller = controller
+        elif settings:
             self.settings = json.load(settings)
         else:
             if flags:
                 self.settings_file = os.getenv('HOME') + '/' + flags.settings_file
             else:
                 self.settings_file = os.getenv('HOME') + '/' + '.gcalcron2'
+            self.state = open_state(self.settings_file)
             self.load_settings()
+        if 'zones' not in self.settings:
+            # saved as a list, kept as a store of Events keyed by event id
+            events = self.settings.get('events')
+            if isinstance(events, EventStore):
+                events.tz = self.tz()
+            else:
+                self.settings['events'] = EventStore(events or [], self.tz())
+            if self.local_recurrence():
+                self.settings['recurring'] = RecurringEvents.from_json(self.settings.get('recurring'), self.tz())
         self.gCalAdapter = gCalAdapter
 
     def load_settings(self):
-        try:
-            with open(self.settings_file) as f:
-                self.settings = json.load(f)
-        except IOError:
+        self.settings = self.state.load()
+        if self.settings is None:
             calendarId = input(
                 'Calendar id (in the form of XXXXX....XXXX@group.calendar.google.com or for the main one just your Google email): ')
             relay_pin = int(input(
@@ -212,14 +536,17 @@ class GCalCron:
             self.init_settings(calendarId, relay_pin)
             self.save_settings()
 
-    def save_settings(self):
-        with open(self.settings_file, 'w') as f:
-            json.dump(self.settings, f, indent=2)
+    def save_settings(self, force=False):
+        """save the settings if they have changed, see state_store for when a new sync position alone is saved"""
+        if self.controller:
+            self.controller.save_settings(force)
+            return
+        self.state.save(self.settings, force)
 
     def init_settings(self, calendarId,
                       relay_pin):
         self.settings = {
-            "events": [],
+            "events": EventStore(),
             "calendarId": calendarId,
             "relay_pin": relay_pin,  # the pin that the relay is controlled by
             "last_sync": None
@@ -228,12 +555,71 @@ class GCalCron:
     def getCalendarId(self):
         return self.settings["calendarId"]
 
+    def local_recurrence(self):
+        """True if the settings ask for recurring events to be expanded here rather than by google"""
+        settings = self.controller.settings if self.controller else self.settings
+        return settings.get('recurrence') == 'local'
+
+    def calendar_ids(self):
+        return [self.getCalendarId()]
+
+    def setting(self, key, default=None):
+        """a setting of the zone, or failing that of the zones file"""
+        if key in self.settings:
+            return self.settings[key]
+        if self.controller:
+            return self.controller.settings.get(key, default)
+        return default
+
+    def poll_scheduler(self):
+        """the PollScheduler of the "poll" settings, or None to poll on every run"""
+        return PollScheduler.from_settings(self.settings)
+
+    def relay_backend(self):
+        """the relay backend named by "relay_backend" in the settings (of the zone, or of the zones file)"""
+        return get_backend(self.setting('relay_backend'))
+
+    def days_ahead(self):
+        """how far ahead events are synced and recurring events expanded, "days_ahead" in the settings"""
+        return datetime.timedelta(days=self.setting('days_ahead', DAYS_AHEAD))
+
+    def min_dwell(self):
+        """seconds the relay stays in a position before it is switched again, "min_dwell" in the settings"""
+        return self.setting('min_dwell', 0)
+
+    def tz(self):
+        """the calendar's timezone, in which its all-day events start and end, or None if not known yet"""
+        return gettz(self.settings['timeZone']) if self.settings.get('timeZone') else None
+
+    def set_time_zone(self, time_zone):
+        """save the calendar's timezone when google says what it is, moving the all-day events to it"""
+        if not time_zone or time_zone == self.settings.get('timeZone'):
+            return
+        if gettz(time_zone) is None:
+            logger.warning('unknown timezone {0} - keeping all-day events in {1}'.format(
+                time_zone, self.settings.get('timeZone', 'local time')))
+            return
+        logger.info('all-day events of {0} are in {1}'.format(self.getCalendarId(), time_zone))
+        self.settings['timeZone'] = time_zone
+        self.settings['events'].set_tz(self.tz())
+        if 'recurring' in self.settings:
+            self.settings['recurring'].set_tz(self.tz())
+
     def reset_settings(self):
-        self.settings['last_sync'] = None
-        self.settings['events'] = []
-        self.save_settings()
+        self.reset_zone()
+        self.save_settings(force=True)
 
-    def sync_gcal_to_cron(self, num_days=datetime.timedelta(days=7), verbose=True):
+    def reset_zone(self):
+        """forget the saved events and where the sync had got to, so the next sync starts from scratch"""
+        self.settings['last_sync'] = None
+        self.settings['events'] = EventStore(tz=self.tz())
+        if 'recurring' in self.settings:
+            self.settings['recurring'] = RecurringEvents(tz=self.tz())
+        self.settings.pop('sync_token', None)
+        self.settings.pop('sync_token_start', None)
+        self._timeline = None
+
+    def sync_gcal_to_cron(self, num_days=None, verbose=True):
         """
     - fetches a list events through the GoogleCalendar adapter
     - merge new events with the local events in the settings file
@@ -241,146 +627,558 @@ class GCalCron:
 
     @author Tim Brooks
     @since 2014-12-01
+
+    Whatever goes wrong fetching the events, the relay is still updated from the saved ones.
+    Returns True if the events were synced.
     """
+        return sync_when_due(self, num_days)
 
+    def fetch(self, num_days=None):
+        """
+    fetches the new and updated events from google, without changing anything, so it can run on a
+    thread of its own. Returns the changes for apply(): one (zone, new events, sync start, sync
+    token, full sync) tuple for each zone (GCalCron) whose calendar could be fetched.
+    """
+        num_days = num_days or self.days_ahead()
+        sync_start, last_sync = self.sync_window(num_days)
+        if self.uses_sync_token():
+            sync_token = self.sync_token(sync_start)
+            new_events, next_sync_token, full_sync = self.gCalAdapter.get_changes(sync_start, sync_token, num_days)
+            return [(self, new_events, sync_start, next_sync_token, full_sync)]
+        return [(self, self.gCalAdapter.get_events(sync_start, last_sync, num_days), sync_start, None, False)]
+
+    def apply(self, changes, now=None):
+        """merges the changes fetch() returned into the saved events, and updates the relay"""
+        apply_changes(self, changes, now)
+
+    def uses_sync_token(self):
+        """True if the settings ask for incremental syncs with google's sync tokens rather than time windows"""
+        return self.settings.get('sync_mode') == 'token'
+
+    def sync_token(self, sync_start):
+        """the saved sync token, or None when a full sync is due because there is none or it is too old"""
+        token_start = self.settings.get('sync_token_start')
+        if not self.settings.get('sync_token') or not token_start \
+                or dateutil.parser.parse(token_start) + SYNC_TOKEN_LIFETIME < sync_start:
+            return None
+        return self.settings['sync_token']
+
+    def sync_window(self, num_days=datetime.timedelta(days=7)):
+        """start of this sync, and the last sync if it is recent enough to only fetch the changes since then"""
         last_sync = None
         # if we have recorded the last time we sync'ed
         if self.settings['last_sync']:
             temp = dateutil.parser.parse(self.settings['last_sync'])
             # and the last time was more than num_days ago (because that would only get events in the past...)
-            if temp - datetime.timedelta(days=0) > datetime.datetime.now(gettz()) - num_days:
+            if temp - datetime.timedelta(days=0) > datetime.datetime.now(LOCAL_TZ) - num_days:
                 last_sync = temp
 
-        sync_start = datetime.datetime.now(gettz())
+        return datetime.datetime.now(LOCAL_TZ), last_sync
+
+    def merge(self, new_events, sync_start, sync_token=None, time_zone=None, full_sync=False):
+        """
+    merge new and updated events to the locally saved ones, time_zone being the calendar's.
+    A full sync has all the events there are, and replaces the saved ones: events deleted while the
+    sync token was out of date may not come back as cancelled. Its sync_token starts the next
+    incremental syncs.
+    """
+        self.set_time_zone(time_zone)
+        if full_sync:
+            self.reset_zone()
+        if new_events and 'recurring' in self.settings:
+            new_events = [event for event in new_events if not self.settings['recurring'].upsert(event)]
+        local_events = self.settings['events']
+        self.settings['events'] = merge_events(local_events, new_events)
+        self.settings['last_sync'] = str(sync_start)
+        if full_sync:
+            self.settings['sync_token'] = sync_token
+            self.settings['sync_token_start'] = str(sync_start)
+        elif sync_token:
+            self.settings['sync_token'] = sync_token
 
-        # get new and updated events (if connected to the internet)
-        new_events = None
+    def evaluate(self, now, switch=True):
+        """
+    - decides if relay should be on or off from the locally saved events (unless switch is False,
+      when the ZoneController has switched it with the other relays of its board)
+    - prunes events that are in the past
+    """
+        # update the relay position, pruning even if the relay cannot be switched
         try:
-            new_events = self.gCalAdapter.get_events(sync_start, last_sync, num_days)
-        except httplib2.ServerNotFoundError:
-            logger.error('server not found - not updating local events')
+            if switch:
+                self.switch(now)
+        finally:
+            self.settings['events'] = prune_old_events(self.settings['events'], now)
+            if 'recurring' in self.settings:
+                self.settings['recurring'].prune(_midnight(now))
+
+    def switch(self, now):
+        """switch the relay to the position the events want now, if that is a change"""
+        position = self.pending_switch(now)
+        if position is None:
+            self.settings['relay_state'] = self._commanded
+        else:
+            self.switched(self.relay_backend().relay(pin=self.settings['relay_pin'], position=position), now)
 
-        # merge them to locally saved
-        local_events = self.settings['events']
-        events = merge_events(local_events, new_events)
+    def pending_switch(self, now, current=None):
+        """
+    the position the relay should be switched to now, or None if it should stay as it is: because it
+    is there already, or because it has not been in its position for min_dwell yet. The relay is only
+    read (or current taken as its position) the first time, after that its position is remembered.
+    """
+        if self._commanded is None:
+            self._commanded = current if current is not None else \
+                self.relay_backend().relay(pin=self.settings['relay_pin'])
+        position = 1 if self.timeline().active(now.timestamp()) else 0
+        if position == self._commanded:
+            return None
+        if now.timestamp() < self.settings.get('relay_changed', 0) + self.min_dwell():
+            logger.debug('leaving relay {0} {1} for its minimum dwell time'.format(
+                self.settings['relay_pin'], 'on' if self._commanded else 'off'))
+            return None
+        return position
+
+    def switched(self, state, now):
+        """remember that the relay has been switched, and is now in position state"""
+        if state != self._commanded:
+            logger.info('turned relay {0} {1} at  {2}'.format(self.settings['relay_pin'], 'on' if state else 'off', now))
+            self.settings['relay_changed'] = int(now.timestamp())
+        self._commanded = state
+        self.settings['relay_state'] = state
+
+    def timeline(self):
+        """the Timeline of the saved events, rebuilt only when they have changed"""
+        events = self.settings['events']
+        version = (id(events), events.version)
+        recurring = self.settings.get('recurring')
+        if recurring is not None:
+            # the recurring events are expanded from yesterday to a day past the days_ahead synced
+            start = _midnight(datetime.datetime.now(LOCAL_TZ)) - 24 * 3600
+            end = start + int(self.days_ahead().total_seconds()) + 2 * 24 * 3600
+            version += (id(recurring), recurring.version, start)
+        if self._timeline is None or self._timeline_version != version:
+            events.on_change = self._event_changed
+            if recurring is not None:
+                events = itertools.chain(events, recurring.expand(start, end))
+            self._timeline = Timeline.from_events(events)
+            self._timeline_version = version
+        return self._timeline
+
+    def _event_changed(self, old, new):
+        """add a new event to the timeline in place, other changes rebuild it when it is next needed"""
+        events = self.settings['events']
+        if old is None and self._timeline is not None \
+                and self._timeline_version[:2] == (id(events), events.version - 1):
+            self._timeline.add(new.start, new.end)
+            self._timeline_version = (id(events), events.version) + self._timeline_version[2:]
+
+    def write_schedule(self, f, now, num_days=None):
+        """write the relay's position now and its changes over num_days as CSV rows of relay pin, time, on/off"""
+        end = now + (num_days or self.days_ahead())
+        self.timeline().write_csv(f, now.timestamp(), end.timestamp(), now.tzinfo, self.settings['relay_pin'])
+
+    def refresh_relay(self, now):
+        """
+    updates the relay from the locally saved events and saves the settings.
+    No network access is needed, so the daemon calls this on its own at relay transitions.
+    """
+        try:
+            self.evaluate(now)
+        finally:
+            self.save_settings()
 
-        # update the relay position
-        update_relay(self.settings['relay_pin'], events, datetime.datetime.now(gettz()))
+    def next_transition(self, now):
+        """Time at which the relay is next due to change position, or None if no events are pending"""
+        transition = next_transition(self.timeline(), now)
+        held_until = self.settings.get('relay_changed', 0) + self.min_dwell()
+        if held_until > now.timestamp() and self._commanded != self.timeline().active(now.timestamp()):
+            # a change put off by the minimum dwell time is due when that is over
+            held_until = to_datetime(held_until, now.tzinfo)
+            return min(transition, held_until) if transition else held_until
+        return transition
 
-        events = prune_old_events(events, datetime.datetime.now(gettz()))
 
-        self.settings['last_sync'] = str(sync_start)
-        self.settings['events'] = events
+class ZoneController:
+    """
+  Controls several relays, each from its own calendar, from a single settings file
+  and a single process. The events of all zones are fetched in one batched request.
+
+  The settings file lists the zones, and optionally "sync_mode": "token" for incremental syncs
+  and "recurrence": "local" to expand recurring events locally:
+  {"zones": [{"calendarId": "...", "relay_pin": 4, "events": [], "last_sync": null}, ...]}
+  """
+
+    def __init__(self, state, settings, gCalAdapter=None):
+        self.state = state
+        self.settings = settings
+        self.gCalAdapter = gCalAdapter
+        self.zones = [GCalCron(zone=zone, controller=self) for zone in settings['zones']]
+        if gCalAdapter and settings.get('recurrence') == 'local':
+            gCalAdapter.single_events = False
+
+    def save_settings(self, force=False):
+        self.state.save(self.settings, force)
+
+    def poll_scheduler(self):
+        return PollScheduler.from_settings(self.settings)
+
+    def calendar_ids(self):
+        return [zone.getCalendarId() for zone in self.zones]
+
+    def reset_settings(self):
+        for zone in self.zones:
+            zone.reset_zone()
+        self.save_settings(force=True)
+
+    def sync_gcal_to_cron(self, num_days=None, verbose=True):
+        """same as GCalCron.sync_gcal_to_cron, for all the zones at once"""
+        return sync_when_due(self, num_days)
+
+    def days_ahead(self):
+        """same as GCalCron.days_ahead, for all the zones"""
+        return datetime.timedelta(days=self.settings.get('days_ahead', DAYS_AHEAD))
+
+    def fetch(self, num_days=None):
+        """same as GCalCron.fetch, for all the zones at once in a batched request. Raises IOError if no zone could be fetched"""
+        num_days = num_days or self.days_ahead()
+        windows = [zone.sync_window(num_days) for zone in self.zones]
+        if self.settings.get('sync_mode') == 'token':
+            sync_tokens = [zone.sync_token(sync_start) for zone, (sync_start, last_sync) in zip(self.zones, windows)]
+            results = self.gCalAdapter.get_zone_changes(
+                [(zone.getCalendarId(), sync_start, sync_token)
+                 for zone, (sync_start, last_sync), sync_token in zip(self.zones, windows, sync_tokens)], num_days)
+            changes = [(zone, result[0], sync_start, result[1], result[2])
+                       for zone, (sync_start, last_sync), result in zip(self.zones, windows, results)
+                       if result is not None]
+        else:
+            results = self.gCalAdapter.get_zone_events(
+                [(zone.getCalendarId(), sync_start, last_sync) for zone, (sync_start, last_sync) in zip(self.zones, windows)],
+                num_days)
+            changes = [(zone, events, sync_start, None, False)
+                       for zone, (sync_start, last_sync), events in zip(self.zones, windows, results) if events is not None]
+        if self.zones and not changes:
+            raise IOError('none of the zones could be synced')
+        return changes
+
+    def apply(self, changes, now=None):
+        """same as GCalCron.apply, for all the zones"""
+        apply_changes(self, changes, now)
+
+    def refresh_relay(self, now):
+        """same as GCalCron.refresh_relay, switching the relays of a board that can do so together in one go"""
+        boards = {}  # id of the backend -> the backend and its zones
+        for zone in self.zones:
+            backend = zone.relay_backend()
+            if hasattr(backend, 'set_relays'):
+                boards.setdefault(id(backend), (backend, []))[1].append(zone)
+        switched = []
+        for backend, zones in boards.values():
+            # a board that fails leaves the other boards and zones to be switched
+            try:
+                self._switch_board(backend, zones, now)
+            except Exception:
+                logger.exception('Relay update failed for relays {0}'.format(
+                    ', '.join(str(zone.settings['relay_pin']) for zone in zones)))
+            switched += zones
+        for zone in self.zones:
+            try:
+                zone.evaluate(now, switch=zone not in switched)
+            except Exception:
+                logger.exception('Relay update failed for relay {0}'.format(zone.settings['relay_pin']))
         self.save_settings()
 
+    @staticmethod
+    def _switch_board(backend, zones, now):
+        """switch the relays of zones that are on the board backend, with one read and one write"""
+        current = {}
+        if any(zone._commanded is None for zone in zones) and hasattr(backend, 'read_relays'):
+            current = backend.read_relays()
+        pending = {}
+        for zone in zones:
+            position = zone.pending_switch(now, current.get(zone.settings['relay_pin']))
+            if position is None:
+                zone.settings['relay_state'] = zone._commanded
+            else:
+                pending[zone] = position
+        if pending:
+            states = backend.set_relays({zone.settings['relay_pin']: position for zone, position in pending.items()})
+            for zone in pending:
+                zone.switched(states[zone.settings['relay_pin']], now)
+
+    def next_transition(self, now):
+        transitions = [t for t in (zone.next_transition(now) for zone in self.zones) if t]
+        return min(transitions) if transitions else None
+
+    def write_schedule(self, f, now, num_days=None):
+        for zone in self.zones:
+            zone.write_schedule(f, now, num_days)
+
+
+def load_controller(flags):
+    """GCalCron for a single zone settings file or ZoneController for a multi-zone one, with its GCalAdapter"""
+    g = GCalCron(flags=flags)
+    if 'zones' in g.settings:
+        adapter = GCalAdapter(flags=flags)
+        adapter.transport.breaker = CircuitBreaker.from_settings(g.settings)
+        return ZoneController(g.state, g.settings, adapter)
+    g.gCalAdapter = GCalAdapter(g.getCalendarId(), flags)
+    g.gCalAdapter.single_events = not g.local_recurrence()
+    g.gCalAdapter.transport.breaker = CircuitBreaker.from_settings(g.settings)
+    return g
+
 
 def merge_events(local_events=[], new_events=None):
     """
-  merges new and updated events to the locally saved events.
+  merges new and updated events to the locally saved events, returning them as an EventStore.
+  Cancelled events are removed.
   >>> le = []
-  >>> ne = [{u'description': u'description 1', u'id': u'1'}]
+  >>> ne = [{u'start': {u'dateTime': u'2014-12-07T21:00:00+01:00'}, u'end': {u'dateTime': u'2014-12-07T22:00:00+01:00'}, u'id': u'1'}]
   >>> le = merge_events(le, ne)
-  >>> le
-  [{u'description': u'description 1', u'id': u'1'}]
-  >>> ne = [{u'description': u'new description 1', u'id': u'1'}]
+  >>> le.to_json()
+  [['1', 1417982400, 1417986000]]
+  >>> ne = [{u'start': {u'dateTime': u'2014-12-07T20:00:00+01:00'}, u'end': {u'dateTime': u'2014-12-07T22:00:00+01:00'}, u'id': u'1'}]
   >>> le = merge_events(le, ne)
-  >>> le
-  [{u'description': u'new description 1', u'id': u'1'}]
-  >>> ne = [{u'description': u'description 2', u'id': u'2'}]
+  >>> le.to_json()
+  [['1', 1417978800, 1417986000]]
+  >>> ne = [{u'start': {u'dateTime': u'2014-12-08T20:00:00+01:00'}, u'end': {u'dateTime': u'2014-12-08T22:00:00+01:00'}, u'id': u'2'}]
   >>> le = merge_events(le, ne)
-  >>> le
-  [{u'description': u'new description 1', u'id': u'1'}, {u'description': u'description 2', u'id': u'2'}]
+  >>> le.to_json()
+  [['1', 1417978800, 1417986000], ['2', 1418065200, 1418072400]]
+  >>> ne = [{u'status': u'cancelled', u'id': u'1'}]
+  >>> merge_events(le, ne).to_json()
+  [['2', 1418065200, 1418072400]]
   """
-    if new_events:
-        for index, event in enumerate(new_events):  # enumerate?
-            # for each new event, if eventid is in local calendar, replace that event
-            matched_local_event = next((le for le in local_events if le[u'id'] == event[u'id']), None)
-            if matched_local_event:
-                # event index?
-                local_events[local_events.index(matched_local_event)] = event
-            else:
-                local_events.append(event)
+    if not isinstance(local_events, EventStore):
+        local_events = EventStore(local_events)
+    local_events.merge(new_events)
     return local_events
 
 
-def update_relay(pin, events, now):
+def update_relay(pin, events, now, backend=None):
     """switch relay position to closed if there is currently an event. If not, open the relay
   
   Arguments:
   - `pin`: pin that the relay is connected too
-  - `events`: list of google calendar events (json)
+  - `events`: list of google calendar events (json), or their Timeline
   - `now`: date time now
+  - `backend`: the relay backend, see relay_backends.py, the default one if not given
 
   >>> pin = 1
   >>> events = ([{u'status': u'confirmed', u'updated': u'2013-12-22T19:49:13.750Z', u'end': {u'dateTime': u'2014-12-07T22:00:00+01:00'}, u'description': u'', u'summary': u'heat', u'start': {u'dateTime': u'2014-12-07T21:00:00+01:00'}, u'id': u'olbia2urfm1ns0h88v4u0d9a5g'}])
-  >>> now = datetime.datetime(2014, 12, 7, 21, 25, 52, 93975)
-  >>> update_relay(pin, events, now)
+  >>> now = datetime.datetime(2014, 12, 7, 21, 25, 52, 93975, tzinfo=dateutil.tz.tzoffset(None, 3600))
+  >>> backend = get_backend('mock')
+  >>> update_relay(pin, events, now, backend)
   1
-  >>> relay(pin = pin, position = 0)
+  >>> backend.relay(pin = pin, position = 0)
   0
   >>> events = ([{u'status': u'cancelled', u'updated': u'2013-12-22T19:49:13.750Z', u'end': {u'dateTime': u'2014-12-07T22:00:00+01:00'}, u'description': u'', u'summary': u'heat', u'start': {u'dateTime': u'2014-12-07T21:00:00+01:00'}, u'id': u'olbia2urfm1ns0h88v4u0d9a52g'}])
-  >>> update_relay(pin, events, now)
+  >>> update_relay(pin, events, now, backend)
   0
   >>> events = ([{u'status': u'confirmed', u'updated': u'2013-12-22T19:49:13.750Z', u'end': {u'dateTime': u'2114-12-07T22:00:00+01:00'}, u'description': u'', u'summary': u'heat', u'start': {u'dateTime': u'2114-12-07T21:00:00+01:00'}, u'id': u'olbia2urfm1ns0h88v4u0d9a5g'}, {u'status': u'confirmed', u'updated': u'2013-12-22T19:49:13.750Z', u'end': {u'dateTime': u'2013-12-07T22:00:00+01:00'}, u'description': u'', u'summary': u'heat', u'start': {u'dateTime': u'2013-12-07T21:00:00+01:00'}, u'id': u'olbia2urfm1ns0h88v4u0d9a5g'}])
-  >>> update_relay(pin, events, now)
+  >>> update_relay(pin, events, now, backend)
   0
   """
     # print('now:', now)
+    relay = (backend or get_backend()).relay
     # read current relay position
     relay_pos = relay(pin=pin)
-    set_relay = 0  # default is to set relay off
-    for event in events:  # for each event
-        try:
-            start_time = dateutil.parser.parse(event['start']['dateTime'])
-            end_time = dateutil.parser.parse(event['end']['dateTime'])
-        except KeyError:
-            continue  # No Start or End Times are defined, so skip this event
-        # print(start_time)
-        # print(end_time)
-        # print(event['status'])
-        logger.debug(event['status'])
-        if event[u'status'] != u'cancelled':  # if the event hasn't been canceled
-            if start_time < now < end_time:  # and the event is currently occuring
-                set_relay = 1  # turn relay on
-                # print('relay should be on')
-                break  # no need to look further
-
-    relay(pin=pin, position=set_relay)  # set new relay position
+    if not isinstance(events, Timeline):
+        events = Timeline.from_events(EventStore(events))
+    # turn relay on if an event is currently occuring, default is to set relay off
+    set_relay = 1 if events.active(now.timestamp()) else 0
+
     if relay_pos != set_relay:
-        if relay(pin=pin) == 1:
+        relay_pos = relay(pin=pin, position=set_relay)  # set new relay position, only if it is a change
+        if relay_pos == 1:
             logger.info('turned relay {0} on at  {1}'.format(pin, now))
-            # print('turned relay {0} on at  {1}'.format(pin, now))
-            # return 1
         else:
             logger.info('turned relay {0} off at  {1}'.format(pin, now))
-            # print('turned relay {0} off at {1}'.format(pin, now))
-            # return 0
-    return relay(pin=pin)
+    return relay_pos
+
+
+def next_transition(events, now):
+    """time of the next start or end of a (not cancelled) event after now, or None if there is none
+
+  Arguments:
+  - `events`: list of json events, or their Timeline
+  - `now`: datetime now
+
+  >>> events = ([{u'status': u'confirmed', u'end': {u'dateTime': u'2014-12-07T22:00:00+01:00'}, u'start': {u'dateTime': u'2014-12-07T21:00:00+01:00'}, u'id': u'1'}])
+  >>> next_transition(events, dateutil.parser.parse('2014-12-07T21:30:00+01:00'))
+  datetime.datetime(2014, 12, 7, 22, 0, tzinfo=tzoffset(None, 3600))
+  >>> next_transition(events, dateutil.parser.parse('2014-12-07T22:30:00+01:00'))
+  """
+    if not isinstance(events, Timeline):
+        events = Timeline.from_events(EventStore(events))
+    return to_datetime(events.next_change(now.timestamp()), now.tzinfo)
 
 
 def prune_old_events(events, now):
-    """ remove events that are in the past
+    """ remove events that ended before today
   
   Arguments:
-  - `events`: list of json events
+  - `events`: EventStore of the saved events
   - `now`: datetime now
   
-  >>> events = ([{u'status': u'confirmed', u'updated': u'2013-12-22T19:49:13.750Z', u'end': {u'dateTime': u'2114-12-07T22:00:00+01:00'}, u'description': u'', u'summary': u'heat', u'start': {u'dateTime': u'2114-12-07T21:00:00+01:00'}, u'id': u'olbia2urfm1ns0h88v4u0d9a5g'}, {u'status': u'confirmed', u'updated': u'2013-12-22T19:49:13.750Z', u'end': {u'dateTime': u'2013-12-07T22:00:00+01:00'}, u'description': u'', u'summary': u'heat', u'start': {u'dateTime': u'2013-12-07T21:00:00+01:00'}, u'id': u'olbia2urfm1ns0h88v4u0d9a5g'}])
+  >>> events = EventStore([{u'status': u'confirmed', u'updated': u'2013-12-22T19:49:13.750Z', u'end': {u'dateTime': u'2114-12-07T22:00:00+01:00'}, u'description': u'', u'summary': u'heat', u'start': {u'dateTime': u'2114-12-07T21:00:00+01:00'}, u'id': u'olbia2urfm1ns0h88v4u0d9a5g'}, {u'status': u'confirmed', u'updated': u'2013-12-22T19:49:13.750Z', u'end': {u'dateTime': u'2013-12-07T22:00:00+01:00'}, u'description': u'', u'summary': u'heat', u'start': {u'dateTime': u'2013-12-07T21:00:00+01:00'}, u'id': u'olbia2urfm1ns0h88v4u0d9a52g'}])
   >>> now = datetime.datetime(2014, 12, 7, 21, 36, 35, 63970)
-  >>> prune_old_events(events, now)
-  [{u'status': u'confirmed', u'updated': u'2013-12-22T19:49:13.750Z', u'end': {u'dateTime': u'2114-12-07T22:00:00+01:00'}, u'description': u'', u'summary': u'heat', u'start': {u'dateTime': u'2114-12-07T21:00:00+01:00'}, u'id': u'olbia2urfm1ns0h88v4u0d9a5g'}]
+  >>> prune_old_events(events, now).to_json()
+  [['olbia2urfm1ns0h88v4u0d9a5g', 4573656000, 4573659600]]
   """
-    for event in events:  # for each event
-        try:
-            end_time = dateutil.parser.parse(event['end']['dateTime']).date()
-        except KeyError:
-            end_time = dateutil.parser.parse(event['end']['date']).date()
-        if end_time < now.date():  # and the event is currently occuring
-            logger.info('removing event {0}: in the past'.format(event[u'id']))
-            events.remove(event)
+    for event in events.expire(_midnight(now)):
+        logger.info('removing event {0}: in the past'.format(event.id))
     return events
 
 
+def _midnight(now):
+    """seconds since the epoch of the start of the day of datetime now"""
+    return now.replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+
+
+def apply_changes(g, changes, now=None):
+    """
+  merge the changes the fetch() of the GCalCron (or ZoneController) g returned into the saved events of
+  their zones, and update the relays
+  """
+    for zone, new_events, sync_start, sync_token, full_sync in changes:
+        zone.merge(new_events, sync_start, sync_token, g.gCalAdapter.time_zones.get(zone.getCalendarId()), full_sync)
+    g.refresh_relay(now or datetime.datetime.now(LOCAL_TZ))
+
+
+def sync_when_due(g, num_days=None):
+    """
+  sync the GCalCron (or ZoneController) g with google calendar, unless its PollScheduler says it is
+  not yet time to, and update the relays. Returns True if the events were synced.
+  """
+    now = datetime.datetime.now(LOCAL_TZ)
+    scheduler = g.poll_scheduler()
+    if scheduler and not scheduler.due(now):
+        logger.info('next sync in {0:.0f}s'.format(scheduler.wait(now)))
+        _apply(g, [], now)
+        return False
+
+    # get new and updated events (if connected to the internet)
+    changes = None
+    try:
+        changes = g.fetch(num_days)
+    except CircuitOpenError as error:
+        logger.warning('not syncing: {0}'.format(error))
+    except Exception:
+        logger.exception('sync failed - not updating local events')
+    _apply(g, changes or [])
+    if scheduler:
+        scheduler.done(now, g.next_transition(now), ok=changes is not None)
+        g.save_settings()
+    return changes is not None
+
+
+def _apply(g, changes, now=None):
+    """g.apply(changes, now), saving what was fetched even if a relay cannot be switched"""
+    try:
+        g.apply(changes, now)
+    except Exception:
+        logger.exception('Relay update failed')
+        g.save_settings()
+
+
+def run_daemon(g, interval=60, push=None, evaluate_interval=60, sync_timeout=60):
+    """keep the GCalCron (settings, events and calendar service) resident. The relay is switched from
+  the saved events at the exact start or end of an event, and at least every `evaluate_interval`
+  seconds, and never waits for the network: google calendar is synced on a thread of its own every
+  `interval` seconds (or when the "poll" settings' PollScheduler says), each request giving up after
+  `sync_timeout` seconds, and what it fetched is merged in at the next relay update. Stops cleanly
+  on SIGTERM or SIGINT.
+
+  Arguments:
+  - `g`: GCalCron (or ZoneController) to run
+  - `interval`: seconds between google calendar syncs, without a PollScheduler
+  - `push`: optional PushNotifications, to also sync as soon as google notifies a calendar change
+  - `evaluate_interval`: most seconds between relay updates
+  - `sync_timeout`: seconds for each request to google
+  """
+    stop = threading.Event()
+    wake = threading.Event()  # the sync has fetched changes, or it is time to stop
+    sync_now = threading.Event()
+    fetched = queue.Queue()
+    scheduler = g.poll_scheduler()
+    next_change = [None]  # the relay's next transition, as last worked out by the main loop
+
+    def _stop(signum, frame):
+        logger.info('received signal {0}, stopping'.format(signum))
+        stop.set()
+        wake.set()
+        sync_now.set()
+
+    def _sync():
+        if push:
+            push.renew(datetime.datetime.now(LOCAL_TZ))  # open the channels now rather than after the first sync
+        if scheduler:
+            sync_now.wait(scheduler.wait(datetime.datetime.now(LOCAL_TZ)))
+            sync_now.clear()
+        while not stop.is_set():
+            ok = False
+            try:
+                fetched.put(g.fetch())
+                wake.set()
+                ok = True
+            except CircuitOpenError as error:
+                logger.warning('not syncing: {0}'.format(error))
+            except Exception:
+                logger.exception('Sync failed')
+            wait = interval
+            if scheduler:
+                wait = scheduler.done(datetime.datetime.now(LOCAL_TZ), next_change[0], ok)
+            if push:
+                now = datetime.datetime.now(LOCAL_TZ)
+                wait = min(wait, max((push.renew(now) - now).total_seconds(), 0))
+            sync_now.wait(wait)
+            sync_now.clear()
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    g.gCalAdapter.timeout = sync_timeout
+    if push:
+        push.on_change = lambda calendarId: sync_now.set()
+        push.start()
+    threading.Thread(target=_sync, name='sync', daemon=True).start()
+
+    try:
+        while not stop.is_set():
+            wake.clear()
+            now = datetime.datetime.now(LOCAL_TZ)
+            changes = []
+            while not fetched.empty():
+                changes += fetched.get_nowait()
+            try:
+                _apply(g, changes, now)
+            except Exception:
+                logger.exception('Saving the settings failed')
+
+            now = datetime.datetime.now(LOCAL_TZ)
+            wake_at = now + datetime.timedelta(seconds=evaluate_interval)
+            transition = next_change[0] = g.next_transition(now)
+            if transition and transition < wake_at:
+                wake_at = transition
+            wake.wait(max((wake_at - now).total_seconds(), 0))
+    finally:
+        if push:
+            push.stop()
+        g.save_settings(force=True)
+        close_relays()
+
+
+def first_relay_decision(g):
+    """
+  switch the relays from the saved events, before anything slower such as syncing with google. A relay
+  that cannot be switched (e.g. the relay broker is not running yet) leaves the sync and the daemon to go on.
+  """
+    try:
+        g.refresh_relay(datetime.datetime.now(LOCAL_TZ))
+    except Exception:
+        logger.exception('Relay update failed')
+    STARTUP_TIMES.append(('first relay decision after', time.perf_counter() - _started))
+
+
 def main(argv):
     # Parse the command-line flags.
     flags = parser.parse_args(argv[1:])
@@ -394,15 +1192,36 @@ def main(argv):
     logger.addHandler(fh)
 
     try:
-        g = GCalCron(flags=flags)
-        gCalAdapter = GCalAdapter(g.getCalendarId(), flags)
-        g.gCalAdapter = gCalAdapter
+        with timed('load settings'):
+            g = load_controller(flags)
 
         if flags.reset:
             g.reset_settings()
+        elif flags.schedule:
+            now = datetime.datetime.now(LOCAL_TZ)
+            if flags.schedule == '-':
+                g.write_schedule(sys.stdout, now)
+            else:
+                with open(flags.schedule, 'w', newline='') as f:
+                    g.write_schedule(f, now)
+        elif flags.daemon:
+            first_relay_decision(g)
+            if flags.startup_report:
+                logger.info(startup_report())
+            push = None
+            if flags.push_address:
+                from push_notifications import PushNotifications
+                push = PushNotifications(g.gCalAdapter, flags.push_address, g.calendar_ids(),
+                                         token=flags.push_token, port=flags.push_port)
+            run_daemon(g, flags.interval, push, flags.evaluate_interval, flags.sync_timeout)
         else:
-            g.sync_gcal_to_cron()
-            logger.info('Sync succeeded')
+            first_relay_decision(g)
+            with timed('sync'):
+                synced = g.sync_gcal_to_cron()
+            if synced:
+                logger.info('Sync succeeded')
+            if flags.startup_report:
+                logger.info(startup_report())
     except:
         logging.exception('Sync failed')
 
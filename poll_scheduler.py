@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""When to next poll google calendar.
+
+Polling every minute around the clock mostly fetches nothing: bookings change in the run-up to
+them, not at 3 a.m. with nothing planned for days. With a "poll" section in the settings (at the
+top level of a zones file):
+  "poll": {"min_interval": 60, "max_interval": 1800, "daily_budget": 300}
+google is polled more often the closer the next relay transition is (a quarter of the time left,
+within min_interval and max_interval seconds), and at max_interval when there is none. No more than
+daily_budget polls are made in a day, and the last RESERVE of them are kept for the run-up to a
+transition: once into them, quiet periods wait for the next run-up (or the next day). After an error
+the wait doubles with each failure, with jitter so a fleet of controllers doesn't retry in step.
+
+Without it, the daemon polls every --interval seconds and cron runs poll on every run, as before.
+The schedule is kept in the settings ("poll_state"), so it holds across cron runs.
+"""
+
+import datetime
+import logging
+import random
+
+logger = logging.getLogger(__name__)
+
+# the part of the time left until the next transition to wait before polling again
+LEAD_FRACTION = 0.25
+
+# the part of the daily budget kept for polling in the run-up to transitions
+RESERVE = 0.2
+
+
+class PollScheduler:
+    """
+  The polling schedule, kept in the dict state.
+
+  >>> s = PollScheduler(min_interval=60, max_interval=1800, state={})
+  >>> now = datetime.datetime(2014, 12, 7, 6, 0)
+  >>> s.done(now, next_transition=now + datetime.timedelta(hours=1))
+  900.0
+  >>> s.due(now + datetime.timedelta(minutes=10)), s.due(now + datetime.timedelta(minutes=15))
+  (False, True)
+  >>> s.done(now, next_transition=None)
+  1800
+  """
+
+    def __init__(self, min_interval=60, max_interval=1800, daily_budget=None, state=None):
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.daily_budget = daily_budget
+        self.state = state if state is not None else {}
+        # the next poll, the polls counted on the day, and the failures in a row; all set up front, so
+        # the daemon's sync thread only ever replaces values while the settings are being saved
+        for key, default in (('next', 0), ('day', None), ('count', 0), ('failures', 0)):
+            self.state.setdefault(key, default)
+
+    @classmethod
+    def from_settings(cls, settings):
+        """the scheduler the "poll" section of the settings asks for, keeping its state in them, or None"""
+        poll = settings.get('poll')
+        if not poll:
+            return None
+        return cls(poll.get('min_interval', 60), poll.get('max_interval', 1800), poll.get('daily_budget'),
+                   settings.setdefault('poll_state', {}))
+
+    def due(self, now):
+        """True if it is time to poll again"""
+        return now.timestamp() >= self.state['next']
+
+    def wait(self, now):
+        """seconds until the next poll"""
+        return max(self.state['next'] - now.timestamp(), 0)
+
+    def done(self, now, next_transition=None, ok=True):
+        """
+    note a poll at datetime now, which failed unless ok, and schedule the next one. The relay is
+    next due to change at datetime next_transition, if known. Returns the seconds to the next poll.
+    """
+        day = now.date().toordinal()
+        if self.state['day'] != day:
+            self.state['day'] = day
+            self.state['count'] = 0
+        self.state['count'] += 1
+        self.state['failures'] = 0 if ok else self.state['failures'] + 1
+
+        # seconds until the run-up to the next transition, when polls get more frequent than max_interval
+        run_up = None
+        if next_transition is not None:
+            run_up = max((next_transition - now).total_seconds() - self.max_interval / LEAD_FRACTION, 0)
+
+        if self.state['failures']:
+            backoff = min(self.max_interval, self.min_interval * 2 ** self.state['failures'])
+            interval = random.uniform(backoff / 2, backoff)
+        elif next_transition is not None:
+            interval = (next_transition - now).total_seconds() * LEAD_FRACTION
+            interval = min(max(interval, self.min_interval), self.max_interval)
+        else:
+            interval = self.max_interval
+
+        if self.daily_budget:
+            midnight = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time(), now.tzinfo)
+            rest_of_day = (midnight - now).total_seconds()
+            left = self.daily_budget - self.state['count']
+            if left <= 0:
+                logger.warning('used the {0} polls of the day, next poll tomorrow'.format(self.daily_budget))
+                interval = max(interval, rest_of_day)
+            elif left <= self.daily_budget * RESERVE and run_up != 0:
+                # quiet, and down to the polls kept for the run-up to a transition
+                interval = max(interval, rest_of_day if run_up is None else min(run_up, rest_of_day))
+
+        self.state['next'] = int(now.timestamp() + interval)
+        return interval
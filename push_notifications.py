@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Receive google calendar push notifications, so the heating daemon syncs as soon as someone
+edits a calendar instead of finding out on its next poll.
+
+A notification channel (events.watch) is registered for each calendar, asking google to POST to
+our web hook whenever an event changes. Google doesn't say what changed, so a notification just
+wakes the daemon up for an (incremental) sync. Channels expire, so they are renewed before that.
+The address google posts to must be public https, e.g. through a reverse proxy to this server.
+
+To try the receiver without google, send it a fake notification:
+  $ python push_notifications.py --url http://localhost:8081/notifications --channel <id> --token <push_token>
+using the channel id logged by the daemon and the token it was given with --push_token.
+"""
+
+import argparse
+import datetime
+import logging
+import secrets
+import sys
+import threading
+import uuid
+
+import flask
+import requests
+from werkzeug.serving import make_server
+
+logger = logging.getLogger(__name__)
+
+# how long to ask google to keep a channel open for, and how long before it expires to renew it
+CHANNEL_TTL = datetime.timedelta(days=7)
+RENEW_BEFORE = datetime.timedelta(hours=1)
+
+
+class PushNotifications:
+    """
+  Registers a notification channel for each calendar and serves the web hook google posts to.
+
+  Arguments:
+  - `gCalAdapter`: GCalAdapter used to open and close the channels
+  - `address`: public https url of the web hook, ending in /notifications
+  - `calendar_ids`: calendars to watch
+  - `on_change`: called with the calendarId when one of the calendars has changed
+  - `token`: secret google sends back with each notification, a random one if not given
+  - `host`, `port`: where to serve the web hook
+  """
+
+    def __init__(self, gCalAdapter, address, calendar_ids, on_change=None, token=None, host='0.0.0.0', port=8081):
+        self.gCalAdapter = gCalAdapter
+        self.address = address
+        self.calendar_ids = list(calendar_ids)
+        self.on_change = on_change
+        self.token = token or secrets.token_hex(16)
+        self.channels = {}  # channel id -> {'calendarId', 'resourceId', 'expiration'}
+        self.host = host
+        self.port = port
+        self.server = None
+
+        self.app = flask.Flask(__name__)
+        self.app.add_url_rule('/notifications', 'notifications', self.receive, methods=['POST'])
+
+    def receive(self):
+        """the web hook: check the notification is from one of our channels and pass it on"""
+        return '', self.handle(flask.request.headers)
+
+    def handle(self, headers):
+        """handle the headers of a notification, returning the http status to answer with"""
+        channel = self.channels.get(headers.get('X-Goog-Channel-ID'))
+        if channel is None or headers.get('X-Goog-Channel-Token') != self.token:
+            logger.warning('ignoring notification for unknown channel {0}'.format(headers.get('X-Goog-Channel-ID')))
+            return 404
+        state = headers.get('X-Goog-Resource-State')
+        if state == 'sync':
+            # sent once when the channel is opened, nothing has changed yet
+            return 200
+        logger.info('calendar {0} changed ({1})'.format(channel['calendarId'], state))
+        if self.on_change:
+            self.on_change(channel['calendarId'])
+        return 200
+
+    def watch(self, calendarId, now):
+        """open a new channel for calendarId"""
+        channel_id = str(uuid.uuid4())
+        # register before google posts the sync message, which can arrive before watch() returns
+        self.channels[channel_id] = {'calendarId': calendarId, 'resourceId': None, 'expiration': now + CHANNEL_TTL}
+        try:
+            response = self.gCalAdapter.watch(channel_id, self.address, self.token, CHANNEL_TTL, calendarId)
+        except Exception:
+            del self.channels[channel_id]
+            raise
+        expiration = datetime.datetime.fromtimestamp(int(response['expiration']) / 1000, datetime.timezone.utc)
+        self.channels[channel_id].update(resourceId=response['resourceId'], expiration=expiration)
+        logger.info('watching calendar {0} on channel {1} until {2}'.format(calendarId, channel_id, expiration))
+        return channel_id
+
+    def stop_channel(self, channel_id):
+        channel = self.channels.pop(channel_id)
+        try:
+            self.gCalAdapter.stop_watch(channel_id, channel['resourceId'])
+        except Exception:
+            logger.exception('could not stop channel {0}, it will expire on its own'.format(channel_id))
+
+    def renew(self, now):
+        """
+    open channels for the calendars that have none, or whose channel expires within RENEW_BEFORE,
+    and close the old ones. Returns the time the next channel needs renewing.
+    """
+        for calendarId in self.calendar_ids:
+            current = [channel_id for channel_id, channel in self.channels.items()
+                       if channel['calendarId'] == calendarId]
+            if current and all(self.channels[c]['expiration'] - RENEW_BEFORE > now for c in current):
+                continue
+            try:
+                self.watch(calendarId, now)
+            except Exception:
+                logger.exception('could not watch calendar {0}, relying on polling'.format(calendarId))
+                continue
+            for channel_id in current:
+                self.stop_channel(channel_id)
+
+        if not self.channels:
+            return now + RENEW_BEFORE  # try again later
+        return min(channel['expiration'] for channel in self.channels.values()) - RENEW_BEFORE
+
+    def start(self):
+        """serve the web hook from a background thread"""
+        self.server = make_server(self.host, self.port, self.app, threaded=True)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        logger.info('receiving notifications on {0}:{1}'.format(self.host, self.server.server_port))
+
+    def stop(self):
+        """close all the channels and stop serving"""
+        for channel_id in list(self.channels):
+            self.stop_channel(channel_id)
+        if self.server:
+            self.server.shutdown()
+            self.server = None
+
+
+def send_notification(url, channel_id, token, state='exists', resource_id='fake-resource'):
+    """post a fake notification, the way google would, to a receiver. Returns the http status"""
+    return requests.post(url, headers={
+        'X-Goog-Channel-ID': channel_id,
+        'X-Goog-Channel-Token': token,
+        'X-Goog-Resource-ID': resource_id,
+        'X-Goog-Resource-State': state,
+        'X-Goog-Message-Number': '1',
+    }).status_code
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:8081/notifications', help='the receiver to notify')
+    parser.add_argument('--channel', required=True, help='channel id, as logged by the daemon')
+    parser.add_argument('--token', required=True, help='channel token, as given to the daemon with --push_token')
+    parser.add_argument('--state', default='exists', help='resource state: sync, exists or not_exists')
+
+    flags = parser.parse_args(sys.argv[1:])
+    print(send_notification(flags.url, flags.channel, flags.token, flags.state))
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""Recurring events, expanded locally rather than by google.
+
+With singleEvents=True google sends every instance of a recurring event in the sync window as an
+event of its own, each stored, merged and pruned one by one. With "recurrence": "local" in the
+settings, google sends the recurring event once, with its RRULE/EXDATE lines, plus the instances
+that have been moved or cancelled. Only those are saved; the instances are worked out here with
+dateutil.rrule for the window the relay needs, and cached until the events or the window change.
+"""
+
+import datetime
+import logging
+import re
+
+from dateutil.rrule import rrulestr
+from dateutil.tz import gettz
+
+from event_store import Event, LOCAL_TZ, event_time, move_day
+
+logger = logging.getLogger(__name__)
+
+UNTIL = re.compile(r'UNTIL=(\d{8})(T\d{6})?(Z?)', re.IGNORECASE)
+
+
+def _match_until(line, dtstart):
+    """
+  the rule line with its UNTIL the way dateutil wants it for dtstart: floating for an all-day event (naive
+  dtstart), in UTC for a timed one. Google is not consistent about it, and dateutil rejects any mismatch.
+
+  >>> _match_until('RRULE:FREQ=DAILY;UNTIL=20141205T000000Z', datetime.datetime(2014, 12, 1))
+  'RRULE:FREQ=DAILY;UNTIL=20141205T000000'
+  >>> _match_until('RRULE:FREQ=DAILY;UNTIL=20141205', datetime.datetime(2014, 12, 1, 7, tzinfo=datetime.timezone.utc))
+  'RRULE:FREQ=DAILY;UNTIL=20141205T235959Z'
+  """
+    def until(match):
+        date, time, utc = match.groups()
+        if dtstart.tzinfo is None:
+            return 'UNTIL=' + date + (time or '')
+        if utc:
+            return match.group(0)
+        # a floating UNTIL is in the event's timezone, a date until the end of that day
+        local = datetime.datetime.strptime(date + (time or 'T235959'), '%Y%m%dT%H%M%S').replace(tzinfo=dtstart.tzinfo)
+        return 'UNTIL=' + local.astimezone(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    return UNTIL.sub(until, line)
+
+
+class RecurringEvents:
+    """
+  Recurring events (the series) and their moved or cancelled instances (the exceptions).
+
+  >>> r = RecurringEvents()
+  >>> r.upsert({u'id': u'heat', u'status': u'confirmed', u'recurrence': [u'RRULE:FREQ=DAILY;COUNT=3'], u'start': {u'dateTime': u'2014-12-01T07:00:00Z'}, u'end': {u'dateTime': u'2014-12-01T09:00:00Z'}})
+  True
+  >>> r.upsert({u'id': u'heat_20141202T070000Z', u'status': u'cancelled', u'recurringEventId': u'heat', u'originalStartTime': {u'dateTime': u'2014-12-02T07:00:00Z'}})
+  True
+  >>> r.expand(1417392000, 1417996800)
+  [Event('heat_20141201T070000Z', 1417417200, 1417424400), Event('heat_20141203T070000Z', 1417590000, 1417597200)]
+  """
+
+    def __init__(self, series=None, exceptions=None, tz=None):
+        self.tz = tz  # the calendar's timezone, for the dates of all-day events
+        self.series = series or {}  # id -> {'start', 'end', 'tz', 'all_day', 'rule'}
+        self.exceptions = exceptions or {}  # series id -> {original start: Event, or None if cancelled}
+        self.version = 0
+        self._rules = {}
+        self._expanded = None
+        self._expanded_key = None
+
+    @classmethod
+    def from_json(cls, saved, tz=None):
+        saved = saved or {}
+        exceptions = {series_id: {int(start): Event.from_json(event) if event else None
+                                  for start, event in instances.items()}
+                      for series_id, instances in saved.get('exceptions', {}).items()}
+        return cls(saved.get('series'), exceptions, tz)
+
+    def to_json(self):
+        return {
+            'series': self.series,
+            'exceptions': {series_id: {str(start): event.to_json() if event else None
+                                       for start, event in instances.items()}
+                           for series_id, instances in self.exceptions.items()},
+        }
+
+    def __len__(self):
+        return len(self.series)
+
+    def upsert(self, event):
+        """
+    keep a google calendar event (json) if it is a recurring event or an exception to one,
+    returning True if it was. Any other event is left for the EventStore.
+    """
+        if u'recurrence' in event:
+            if event.get(u'status') == u'cancelled':
+                return self.discard(event[u'id'])
+            all_day = 'dateTime' not in event['start']
+            self.series[event[u'id']] = {
+                'start': event_time(event['start'], self.tz),
+                'end': event_time(event['end'], self.tz),
+                'tz': event['start'].get('timeZone'),
+                'all_day': all_day,
+                'rule': event[u'recurrence'],
+            }
+            self._rules.pop(event[u'id'], None)
+        elif u'recurringEventId' in event:
+            instances = self.exceptions.setdefault(event[u'recurringEventId'], {})
+            original_start = event_time(event['originalStartTime'], self.tz)
+            if event.get(u'status') == u'cancelled':
+                instances[original_start] = None
+            else:
+                instances[original_start] = Event.from_api(event, self.tz)
+        elif event.get(u'status') == u'cancelled' and event[u'id'] in self.series:
+            return self.discard(event[u'id'])
+        else:
+            return False
+        self.version += 1
+        return True
+
+    def set_tz(self, tz):
+        """take the dates of all-day events in timezone tz, moving the saved ones to its midnights"""
+        old_tz, new_tz = self.tz or LOCAL_TZ, tz or LOCAL_TZ
+        self.tz = tz
+        for series_id, series in self.series.items():
+            if series['all_day']:
+                series['start'] = move_day(series['start'], old_tz, new_tz)
+                series['end'] = move_day(series['end'], old_tz, new_tz)
+                self.exceptions[series_id] = {
+                    move_day(start, old_tz, new_tz): event for start, event in self.exceptions.get(series_id, {}).items()}
+            for start, event in self.exceptions.get(series_id, {}).items():
+                if event is not None and event.all_day:
+                    self.exceptions[series_id][start] = Event(event.id, move_day(event.start, old_tz, new_tz),
+                                                              move_day(event.end, old_tz, new_tz), all_day=True)
+        self._rules.clear()
+        self.version += 1
+
+    def _tz(self, series):
+        """the timezone to expand a recurring event in: its own, or the calendar's for all-day ones"""
+        if series['tz'] and not series['all_day']:
+            return gettz(series['tz'])
+        return self.tz or LOCAL_TZ
+
+    def discard(self, series_id):
+        """delete a recurring event and its exceptions"""
+        self.series.pop(series_id, None)
+        self.exceptions.pop(series_id, None)
+        self._rules.pop(series_id, None)
+        self.version += 1
+        return True
+
+    def _rule(self, series_id):
+        """the dateutil rruleset of a recurring event, in the event's timezone"""
+        if series_id not in self._rules:
+            series = self.series[series_id]
+            dtstart = datetime.datetime.fromtimestamp(series['start'], self._tz(series))
+            if series['all_day']:
+                dtstart = dtstart.replace(tzinfo=None)
+            try:
+                self._rules[series_id] = rrulestr('\n'.join(_match_until(line, dtstart) for line in series['rule']),
+                                                  dtstart=dtstart, forceset=True)
+            except (ValueError, TypeError):
+                logger.exception('cannot expand recurring event {0}'.format(series_id))
+                self._rules[series_id] = None
+        return self._rules[series_id]
+
+    def _instances(self, series_id, start, end):
+        """Events of the instances of a recurring event starting from start to end"""
+        series = self.series[series_id]
+        rule = self._rule(series_id)
+        if rule is None:
+            return []
+        tz = self._tz(series)
+        duration = series['end'] - series['start']
+        instances = []
+        if series['all_day']:
+            days = datetime.timedelta(days=round(duration / 86400))
+            window = (datetime.datetime.fromtimestamp(start, tz).replace(tzinfo=None) - days,
+                      datetime.datetime.fromtimestamp(end, tz).replace(tzinfo=None))
+            for day in rule.between(*window, inc=True):
+                instances.append(Event('{0}_{1:%Y%m%d}'.format(series_id, day),
+                                       int(day.replace(tzinfo=tz).timestamp()),
+                                       int((day + days).replace(tzinfo=tz).timestamp()), all_day=True))
+        else:
+            window = (datetime.datetime.fromtimestamp(start - duration, tz), datetime.datetime.fromtimestamp(end, tz))
+            for t in rule.between(*window, inc=True):
+                t = int(t.timestamp())
+                utc = datetime.datetime.fromtimestamp(t, datetime.timezone.utc)
+                instances.append(Event('{0}_{1:%Y%m%dT%H%M%SZ}'.format(series_id, utc), t, t + duration))
+        return instances
+
+    def expand(self, start, end):
+        """
+    Events of all the instances overlapping start to end (seconds since the epoch), with the
+    exceptions applied. The expansion is cached until the events or the window change.
+    """
+        key = (self.version, start, end)
+        if self._expanded_key != key:
+            expanded = []
+            for series_id in self.series:
+                exceptions = self.exceptions.get(series_id, {})
+                for instance in self._instances(series_id, start, end):
+                    if instance.start not in exceptions:
+                        expanded.append(instance)
+                for moved in exceptions.values():
+                    if moved is not None:
+                        expanded.append(moved)
+            self._expanded = [event for event in expanded if event.end > start and event.start < end]
+            self._expanded_key = key
+        return self._expanded
+
+    def prune(self, before):
+        """delete the recurring events with no instances left after before, and the exceptions that ended before it"""
+        for series_id in list(self.series):
+            rule = self._rule(series_id)
+            series = self.series[series_id]
+            after = datetime.datetime.fromtimestamp(before - (series['end'] - series['start']), self._tz(series))
+            if series['all_day']:
+                after = after.replace(tzinfo=None)
+            if rule is not None and rule.after(after) is None:
+                logger.info('removing recurring event {0}: in the past'.format(series_id))
+                self.discard(series_id)
+        for series_id, instances in self.exceptions.items():
+            for original_start in [s for s, e in instances.items() if (e.end if e else s) < before]:
+                del instances[original_start]
+                self.version += 1
@@ -1,33 +1,105 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
+"""switch a relay on a raspberry pi GPIO pin with gpiozero
+
+Each pin gets one DigitalOutputDevice, made the first time the pin is used and kept for the life
+of the process, all on one RPi.GPIO pin factory. Reading or switching a relay after that is a
+call on the device rather than setting up the GPIO again. See relay_backends.py for the other
+boards heating.py can drive.
+
+The pins keep driving the relays when the devices are closed, so a relay stays in position after
+a cron run exits; close(release=True) hands the pins back (and the relays drop out) instead.
+"""
 from gpiozero import DigitalOutputDevice  #
-import gpiozero.pins.rpigpio
 import sys
 import argparse
+import logging
+import threading
 a = 24  # relay A
 b = 25  # relay B
 s = 11  # SPI
 
+logger = logging.getLogger(__name__)
+
+
+def holding_factory():
+    """
+  the RPi.GPIO pin factory, making pins which are left as they are when closed unless released.
+  RPi.GPIO is only imported here, as it cannot be imported away from a raspberry pi.
+  """
+    import gpiozero.pins.rpigpio
+
+    class HoldingPin(gpiozero.pins.rpigpio.RPiGPIOPin):
+        release = False
+
+        def close(self):
+            if self.release:
+                super(HoldingPin, self).close()
+
+    class HoldingFactory(gpiozero.pins.rpigpio.RPiGPIOFactory):
+        release = False
+
+        def __init__(self):
+            super(HoldingFactory, self).__init__()
+            self.pin_class = HoldingPin
+
+        def close(self):
+            if self.release:
+                super(HoldingFactory, self).close()
+
+    return HoldingFactory()
+
+
+class Relays:
+    """one DigitalOutputDevice per pin, made on first use and kept, all on the pin factory make_factory() makes"""
+
+    def __init__(self, make_factory):
+        self.make_factory = make_factory
+        self.factory = None
+        self.devices = {}  # pin -> its DigitalOutputDevice
+        self.lock = threading.Lock()
+
+    def device(self, pin):
+        """the DigitalOutputDevice of a pin, made on first use"""
+        with self.lock:
+            if pin not in self.devices:
+                if self.factory is None:
+                    self.factory = self.make_factory()
+                self.devices[pin] = DigitalOutputDevice(pin, initial_value=None, pin_factory=self.factory)
+            return self.devices[pin]
+
+    def close(self, release=False):
+        """close the devices of all the pins. With release the pins are reset too, switching the relays off"""
+        with self.lock:
+            for rly in self.devices.values():
+                rly.pin.release = release
+                rly.close()
+            self.devices.clear()
+            if self.factory is not None:
+                self.factory.release = release
+                self.factory.close()
+                self.factory = None
 
-def close(self):
-    pass
+    def relay(self, position='not_defined', pin=a):
+        """switch the relay on pin to position (1 or 'closed', 0 or 'open') if given, returning its position"""
+        rly = self.device(pin)
+        if position != 'not_defined':
+            if position == 'closed' or (position != 'open' and int(position) == 1):
+                rly.on()
+            elif position == 'open' or int(position) == 0:
+                rly.off()
+            else:
+                logger.warning('unknown position {}'.format(position))
+        return rly.value
 
 
-gpiozero.pins.rpigpio.RPiGPIOPin.close = close
+_relays = Relays(holding_factory)
+device = _relays.device
+close = _relays.close
 
 
 def relay(position='not_defined', pin=a):
-    rly = DigitalOutputDevice(pin, initial_value=None, pin_factory=gpiozero.pins.rpigpio.RPiGPIOFactory())
-    if position != 'not_defined':
-        if position == 'closed' or int(position) == 1:
-            rly.on()
-            print("on")
-        elif position == 'open' or int(position) == 0:
-            rly.off()
-            print("off")
-        else:
-            print('unknown position {}'.format(position))
-    return rly.value
+    return _relays.relay(position, pin)
 
 
 if __name__ == "__main__":
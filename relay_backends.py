@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""The relay boards heating.py can drive.
+
+"relay_backend" in the settings (at the top level of a zones file, or in one of its zones) picks one:
+ - "gpiozero" (the default): relays on raspberry pi GPIO pins, see relay.py
+ - "ebe": the 2 relay serial usb board, see ebe_relay.py
+ - "slice_of_relay": the slice of relay board, through wiringpi2, see slice_of_relay.py
+ - "mock": gpiozero's mock pins, to run and test heating.py without a raspberry pi
+ - "broker": whichever board relay_broker.py drives, for several heating.py processes sharing it
+
+A backend is anything with a relay(position='not_defined', pin=...) function returning the
+position of the relay, and optionally close(release=False). It is only loaded when first used,
+so only the library of the board in use needs to be installed.
+"""
+
+import importlib
+
+DEFAULT = 'gpiozero'
+
+
+def mock_backend():
+    """relays on gpiozero MockFactory pins, which remember their position and switch nothing"""
+    from gpiozero.pins.mock import MockFactory
+    from relay import Relays
+    return Relays(MockFactory)
+
+
+# name -> function loading the backend
+BACKENDS = {
+    'gpiozero': lambda: importlib.import_module('relay'),
+    'ebe': lambda: importlib.import_module('ebe_relay'),
+    'slice_of_relay': lambda: importlib.import_module('slice_of_relay'),
+    'mock': mock_backend,
+    'broker': lambda: importlib.import_module('relay_broker').BrokerClient(),
+}
+
+_loaded = {}  # name -> backend
+
+
+def register(name, load):
+    """make a backend available as name, load() giving the backend when it is first used"""
+    BACKENDS[name] = load
+    _loaded.pop(name, None)
+
+
+def get_backend(name=None):
+    """the backend called name, or the default one, loaded on first use"""
+    name = name or DEFAULT
+    if name not in _loaded:
+        if name not in BACKENDS:
+            raise ValueError('unknown relay backend {0}, expected one of {1}'.format(name, ', '.join(sorted(BACKENDS))))
+        _loaded[name] = BACKENDS[name]()
+    return _loaded[name]
+
+
+def close_all(release=False):
+    """close the backends that have been used, see relay.close"""
+    for backend in _loaded.values():
+        if hasattr(backend, 'close'):
+            backend.close(release)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""One process owning the relay hardware, for all the heating.py processes of a raspberry pi.
+
+With one heating.py per settings file, each process used to set up the GPIO (or open the serial
+board) for itself, with nothing stopping two of them switching the same board at once. The broker
+opens the relay backend once and switches the relays for everyone, one request at a time, over a
+Unix socket. Give a settings file "relay_backend": "broker" to use it; a relay call is then one
+round trip to the broker.
+
+Start it before the heating.py processes, e.g. from systemd or an @reboot cron line:
+  $ python relay_broker.py --backend gpiozero --socket /tmp/heating_relays.sock
+and point the clients at another socket than the default with the RELAY_BROKER_SOCKET environment
+variable. Each request and answer is a line of JSON:
+  {"pin": 4, "position": 1} -> {"position": 1}    (leave position out to read the relay)
+"""
+
+import argparse
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+
+from relay_backends import get_backend, close_all
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = '/tmp/heating_relays.sock'
+
+
+class RelayBrokerError(IOError):
+    """the broker could not be reached, or could not switch the relay"""
+
+
+class RelayBroker(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+  Serves relay requests on a Unix socket, switching the relays with backend one request at a time.
+
+  Arguments:
+  - `path`: the socket, replaced if it is left over from an earlier broker
+  - `backend`: the relay backend, see relay_backends.py
+  """
+
+    daemon_threads = True
+    request_queue_size = 64  # the zone processes of a board all start on the same cron minute
+
+    def __init__(self, path, backend):
+        if os.path.exists(path):
+            os.remove(path)
+        self.backend = backend
+        self.lock = threading.Lock()
+        socketserver.UnixStreamServer.__init__(self, path, RequestHandler)
+
+    def answer(self, request):
+        """the answer to a request, both dicts"""
+        try:
+            pin = int(request['pin'])
+            with self.lock:
+                position = self.backend.relay(position=request.get('position', 'not_defined'), pin=pin)
+            return {'position': position}
+        except Exception as error:
+            logger.exception('relay request {0} failed'.format(request))
+            return {'error': str(error)}
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """answers the requests of one client connection, one line each, until it closes"""
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                answer = self.server.answer(json.loads(line))
+            except ValueError:
+                answer = {'error': 'not a json request'}
+            self.wfile.write(json.dumps(answer).encode() + b'\n')
+
+
+class BrokerClient:
+    """the relay backend of the heating.py processes using the broker, connected on first use"""
+
+    def __init__(self, path=None, timeout=10):
+        self.path = path or os.environ.get('RELAY_BROKER_SOCKET', DEFAULT_SOCKET)
+        self.timeout = timeout
+        self.sock = None
+        self.rfile = None
+        self.lock = threading.Lock()
+
+    def request(self, request):
+        """send a request to the broker and return its answer, connecting again once if the connection has gone"""
+        with self.lock:
+            for attempt in (1, 2):
+                try:
+                    if self.sock is None:
+                        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                        self.sock.settimeout(self.timeout)
+                        self.sock.connect(self.path)
+                        self.rfile = self.sock.makefile('rb')
+                    self.sock.sendall(json.dumps(request).encode() + b'\n')
+                    line = self.rfile.readline()
+                    if line:
+                        break
+                    error = 'connection closed'
+                except OSError as e:
+                    error = e
+                self._close()
+            else:
+                raise RelayBrokerError('no answer from the relay broker on {0}: {1}'.format(self.path, error))
+        answer = json.loads(line)
+        if 'error' in answer:
+            raise RelayBrokerError(answer['error'])
+        return answer
+
+    def relay(self, position='not_defined', pin=None):
+        request = {'pin': pin}
+        if position != 'not_defined':
+            request['position'] = position
+        return self.request(request)['position']
+
+    def _close(self):
+        if self.rfile is not None:
+            self.rfile.close()
+            self.rfile = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def close(self, release=False):
+        """close the connection, the broker keeps the relays as they are"""
+        with self.lock:
+            self._close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backend', default=None, help='the relay backend the broker drives, see relay_backends.py')
+    parser.add_argument('--socket', default=os.environ.get('RELAY_BROKER_SOCKET', DEFAULT_SOCKET),
+                        help='the Unix socket to serve on')
+
+    flags = parser.parse_args(sys.argv[1:])
+    logging.basicConfig(level=logging.INFO)
+    server = RelayBroker(flags.socket, get_backend(flags.backend))
+    logger.info('relay broker serving on {0}'.format(flags.socket))
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        close_all()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Where the settings, saved events and sync state of heating.py are kept.
+
+By default that is the JSON settings file. A settings file ending in .db or .sqlite is an SQLite
+database instead (in WAL mode), where a run only writes the events and settings that changed, in
+one crash-safe transaction.
+
+Either way, nothing is written when nothing has changed. Most runs only move the sync position
+(last_sync and the sync token) on; that is saved at most every MAX_DEFER, as syncing again from an
+older position is only a little more work. The time of the last write is kept with the settings
+(the JSON file's modification time, or in the database), as cron starts a fresh process every
+minute. JSON files are replaced atomically, so a power cut mid-write leaves the old file rather
+than half a new one.
+
+To move an existing JSON settings file (single or multi-zone) into a database:
+  $ python state_store.py ~/.relay_1_settings.json ~/.relay_1_settings.db
+"""
+
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import sys
+import time
+
+from event_store import Event, EventStore, settings_default
+
+logger = logging.getLogger(__name__)
+
+SQLITE_EXTENSIONS = ('.db', '.sqlite', '.sqlite3')
+
+# the settings keys of the top level of a settings file, zones are numbered from 0
+TOP = -1
+
+# settings that change on every sync but are safe to lose, and how long saving them can be put off
+VOLATILE_KEYS = ('last_sync', 'sync_token', 'sync_token_start')
+MAX_DEFER = 15 * 60
+
+
+def write_atomic(path, text):
+    """replace the file at path with text, so that it is either the old or the new file even after a crash"""
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _stable(settings):
+    """the settings without the VOLATILE_KEYS, at the top level and in each zone"""
+    stable = {key: value for key, value in settings.items() if key not in VOLATILE_KEYS}
+    if 'zones' in stable:
+        stable['zones'] = [_stable(zone) for zone in stable['zones']]
+    return stable
+
+
+def open_state(settings_file):
+    """the state store for a settings file, chosen by its extension"""
+    if settings_file.endswith(SQLITE_EXTENSIONS):
+        return SqliteState(settings_file)
+    return JsonState(settings_file)
+
+
+class JsonState:
+    """settings kept in a JSON file"""
+
+    def __init__(self, settings_file):
+        self.settings_file = settings_file
+        self._saved = None  # the file's content
+        self._saved_stable = None  # and without the VOLATILE_KEYS
+        self._saved_at = 0  # when the file was last written, in seconds since the epoch
+
+    def load(self):
+        """the settings, or None if there are none yet"""
+        try:
+            with open(self.settings_file) as f:
+                settings = json.load(f)
+                self._saved_at = os.fstat(f.fileno()).st_mtime
+        except IOError:
+            return None
+        self._saved = json.dumps(settings, indent=2, default=settings_default)
+        self._saved_stable = json.dumps(_stable(settings), default=settings_default)
+        return settings
+
+    def save(self, settings, force=False):
+        """
+    write the settings if they have changed. A change to the VOLATILE_KEYS alone is only written
+    once MAX_DEFER has passed since the last write, or if force is set.
+    """
+        content = json.dumps(settings, indent=2, default=settings_default)
+        if content == self._saved:
+            return False
+        stable = json.dumps(_stable(settings), default=settings_default)
+        if stable == self._saved_stable and not force and time.time() - self._saved_at < MAX_DEFER:
+            return False
+        write_atomic(self.settings_file, content)
+        self._saved = content
+        self._saved_stable = stable
+        self._saved_at = time.time()
+        return True
+
+    def close(self):
+        pass
+
+
+class SqliteState:
+    """
+  settings kept in an SQLite database: one row per setting and one per event, by zone.
+  Saving writes only the rows that changed since the last load or save.
+  """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS settings (
+            zone INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT,
+            PRIMARY KEY (zone, key));
+        CREATE TABLE IF NOT EXISTS events (
+            zone INTEGER NOT NULL,
+            id TEXT NOT NULL,
+            start INTEGER NOT NULL,
+            end INTEGER NOT NULL,
+            all_day INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (zone, id));
+        CREATE TABLE IF NOT EXISTS saved (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            at REAL NOT NULL);
+        """
+
+    def __init__(self, settings_file):
+        self.settings_file = settings_file
+        self.db = sqlite3.connect(settings_file)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(self.SCHEMA)
+        self._saved = {}  # zone -> {key: value as saved}
+        self._stores = {}  # zone -> the EventStore the events table matches
+        row = self.db.execute('SELECT at FROM saved').fetchone()
+        self._saved_at = row[0] if row else 0  # when the VOLATILE_KEYS were last written, in seconds since the epoch
+
+    def load(self):
+        """the settings, or None if there are none yet"""
+        rows = self.db.execute('SELECT zone, key, value FROM settings').fetchall()
+        if not rows:
+            return None
+        zones = {}
+        for zone, key, value in rows:
+            zones.setdefault(zone, {})[key] = json.loads(value)
+        self._saved = {zone: {key: json.dumps(value) for key, value in values.items()}
+                       for zone, values in zones.items()}
+
+        settings = zones.pop(TOP, {})
+        for zone, values in zones.items():
+            values['events'] = self._load_events(zone)
+        if zones:
+            settings['zones'] = [zones[zone] for zone in sorted(zones)]
+        else:
+            settings['events'] = self._load_events(TOP)
+        return settings
+
+    def _load_events(self, zone):
+        store = EventStore(Event(*row) for row in self.db.execute(
+            'SELECT id, start, end, all_day FROM events WHERE zone = ? ORDER BY rowid', (zone,)))
+        store.take_changes()
+        self._stores[zone] = store
+        return store
+
+    def save(self, settings, force=False):
+        """
+    write the settings and events that have changed. A change to the VOLATILE_KEYS alone is only
+    written once MAX_DEFER has passed since the last write, or if force is set.
+    """
+        if 'zones' in settings:
+            zones = [(TOP, {key: value for key, value in settings.items() if key != 'zones'})]
+            zones += list(enumerate(settings['zones']))
+        else:
+            zones = [(TOP, settings)]
+
+        with self.db:
+            changes = self.db.total_changes
+            for zone, values in zones:
+                self._save_zone(zone, values)
+            if self.db.total_changes == changes and not force and time.time() - self._saved_at < MAX_DEFER:
+                return False
+            for zone, values in zones:
+                self._save_zone(zone, values, volatile=True)
+            if self.db.total_changes == changes:
+                return False
+            saved_at = time.time()
+            self.db.execute('INSERT OR REPLACE INTO saved (id, at) VALUES (0, ?)', (saved_at,))
+        self._saved_at = saved_at
+        return True
+
+    def _save_zone(self, zone, values, volatile=False):
+        """write the changed VOLATILE_KEYS if volatile is set, otherwise the other changed settings and events"""
+        saved = self._saved.setdefault(zone, {})
+        for key, value in values.items():
+            if key == 'events' or (key in VOLATILE_KEYS) != volatile:
+                continue
+            value = json.dumps(value, default=settings_default)
+            if saved.get(key) != value:
+                self.db.execute('INSERT OR REPLACE INTO settings (zone, key, value) VALUES (?, ?, ?)',
+                                (zone, key, value))
+                saved[key] = value
+        for key in [key for key in saved if key not in values and (key in VOLATILE_KEYS) == volatile]:
+            self.db.execute('DELETE FROM settings WHERE zone = ? AND key = ?', (zone, key))
+            del saved[key]
+        if volatile:
+            return
+
+        store = values.get('events')
+        if store is None:
+            return
+        if not isinstance(store, EventStore):
+            store = EventStore(store)
+        if self._stores.get(zone) is not store:
+            # not the events that were loaded (e.g. after a reset): replace them all
+            self.db.execute('DELETE FROM events WHERE zone = ?', (zone,))
+            store.take_changes()
+            changed, deleted = list(store), []
+            self._stores[zone] = store
+        else:
+            changed, deleted = store.take_changes()
+        self.db.executemany('DELETE FROM events WHERE zone = ? AND id = ?', [(zone, id) for id in deleted])
+        self.db.executemany('INSERT OR REPLACE INTO events (zone, id, start, end, all_day) VALUES (?, ?, ?, ?, ?)',
+                            [(zone, e.id, e.start, e.end, int(e.all_day)) for e in changed])
+
+    def close(self):
+        self.db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('source', help='settings file to copy from')
+    parser.add_argument('destination', help='settings file to copy to, .db or .sqlite for a database')
+
+    flags = parser.parse_args(sys.argv[1:])
+    if os.path.exists(flags.destination):
+        sys.exit('{0} already exists'.format(flags.destination))
+    settings = open_state(flags.source).load()
+    if settings is None:
+        sys.exit('no settings in {0}'.format(flags.source))
+    if 'zones' in settings:
+        for zone in settings['zones']:
+            zone['events'] = EventStore(zone.get('events') or [])
+    else:
+        settings['events'] = EventStore(settings.get('events') or [])
+    destination = open_state(flags.destination)
+    destination.save(settings)
+    destination.close()
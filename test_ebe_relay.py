@@ -1,37 +1,95 @@
 """ test ebe_relay.py"""
 
-import mock
 import ebe_relay
 import unittest
-from random import randint
+import threading
+import time
 
-import os, pty, serial
+import os, pty, tty
+
+
+class DummyBoard(threading.Thread):
+    """answers the relay board commands on the master end of a pty"""
+
+    def __init__(self, master, answer=True):
+        threading.Thread.__init__(self, daemon=True)
+        self.master = master
+        self.answer = answer
+        self.d_pos = 0
+        self.received = b''
+
+    def run(self):
+        while True:
+            try:
+                cmds = os.read(self.master, 1000)
+            except OSError:
+                return
+            self.received += cmds
+            for cmd in cmds:
+                cmd = bytes([cmd])
+                if cmd == b'[' and self.answer:
+                    os.write(self.master, bytes([self.d_pos]))
+                if cmd == b'd':
+                    self.d_pos = 3
+                if cmd == b'n':
+                    self.d_pos = 0
+                if cmd == b'e':
+                    self.d_pos |= 1
+                if cmd == b'f':
+                    self.d_pos |= 2
+                if cmd == b'o':
+                    self.d_pos &= 2
+                if cmd == b'p':
+                    self.d_pos &= 1
 
 
 class EbeRelayTest(unittest.TestCase):
     """tests for ebe relay
     """
 
-    master, slave = pty.openpty()
-    s_name = os.ttyname(slave)
-    d_pos = 0
-    def dummy_relay():
-        while true:
-            cmd = os.read(self.master,1000)        
-            if cmd == '[':
-                return self.d_pos
-            if cmd == 'e':
-                self.d_pos |= 1
-            if cmd == 'f' :
-                self.d_pos |= 2
-            if cmd == 'o':
-                self.d_pos &= 2
-            if cmd == 'p':
-                self.d_pos &= 1
-            
+    def board(self, answer=True):
+        master, slave = pty.openpty()
+        tty.setraw(slave)
+        board = DummyBoard(master, answer)
+        board.start()
+        self.addCleanup(os.close, slave)
+        self.addCleanup(os.close, master)
+        self.addCleanup(ebe_relay.close)
+        return board, os.ttyname(slave)
+
     def test_relay_read(self):
-        r=ebe_relay.relay(self.s_name)
+        board, s_name = self.board()
+        r = ebe_relay.relay(s_name)
         assert(r == 0)
 
+    def test_relay_switch(self):
+        board, s_name = self.board()
+        assert ebe_relay.relay(s_name, position=1, pin=2) == 1
+        assert ebe_relay.relay(s_name, pin=1) == 0
+        assert ebe_relay.relay(s_name, position='open', pin=2) == 0
+        assert board.d_pos == 0
+
+    def test_connection_is_kept(self):
+        board, s_name = self.board()
+        ebe_relay.relay(s_name)
+        port = ebe_relay.connection(s_name).ser
+        ebe_relay.relay(s_name, position=1)
+        assert ebe_relay.connection(s_name).ser is port
+
+    def test_set_relays_in_one_round_trip(self):
+        board, s_name = self.board()
+        assert ebe_relay.set_relays({1: 1, 2: 'closed'}, s_name) == {1: 1, 2: 1}
+        assert ebe_relay.set_relays({1: 0, 2: 1}, s_name) == {1: 0, 2: 1}
+        assert ebe_relay.read_relays(s_name) == {1: 0, 2: 1}
+        assert board.received == b'd[of[['
+
+    def test_no_answer(self):
+        board, s_name = self.board(answer=False)
+        conn = ebe_relay.Connection(s_name, timeout=0.05, retries=3)
+        start = time.monotonic()
+        self.assertRaises(ebe_relay.RelayBoardError, conn.status)
+        assert time.monotonic() - start < 1
+        conn.close()
+
 if __name__ == "__main__":
     unittest.main()
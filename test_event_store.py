@@ -0,0 +1,108 @@
+""" test event_store.py"""
+
+import doctest
+import json
+import time
+import unittest
+
+from dateutil.tz import gettz
+
+import event_store
+from event_store import Event, EventStore, settings_default
+
+
+def instances(n, status=u'confirmed', summary=u'heat'):
+    """n instances of a recurring event, as singleEvents=True returns them"""
+    return [{u'id': u'series_{0}'.format(i), u'status': status, u'summary': summary,
+             u'start': {u'dateTime': u'2014-12-07T21:00:00+01:00'},
+             u'end': {u'dateTime': u'2014-12-07T22:00:00+01:00'}} for i in range(n)]
+
+
+class EventStoreTest(unittest.TestCase):
+    """tests for the event store
+    """
+
+    def test_doctests(self):
+        assert doctest.testmod(event_store).failed == 0
+
+    def test_update_keeps_order(self):
+        store = EventStore(instances(3))
+        store.upsert(dict(instances(3)[1], start={u'dateTime': u'2014-12-07T20:00:00+01:00'}))
+        assert [e.id for e in store] == [u'series_0', u'series_1', u'series_2']
+        assert store.get(u'series_1').start == 1417978800
+
+    def test_cancelled_events_are_deleted(self):
+        store = EventStore(instances(3))
+        store.merge([instances(3, status=u'cancelled')[0]])
+        assert u'series_0' not in store
+        assert len(store) == 2
+
+    def test_saved_compactly(self):
+        settings = {u'events': EventStore(instances(2)), u'last_sync': None}
+        saved = json.loads(json.dumps(settings, default=settings_default))
+        assert saved[u'events'] == [[u'series_0', 1417982400, 1417986000], [u'series_1', 1417982400, 1417986000]]
+        assert list(EventStore(saved[u'events'])) == list(settings[u'events'])
+
+    def test_all_day_event(self):
+        event = Event.from_api({u'id': u'1', u'start': {u'date': u'2014-12-07'}, u'end': {u'date': u'2014-12-08'}})
+        assert event.all_day
+        assert event.end - event.start == 86400
+        assert Event.from_json(json.loads(json.dumps(event.to_json()))) == event
+
+    def test_all_day_event_in_calendar_timezone(self):
+        store = EventStore([{u'id': u'1', u'start': {u'date': u'2014-12-07'}, u'end': {u'date': u'2014-12-08'}}],
+                           tz=gettz('UTC'))
+        assert store.get(u'1').start == 1417910400
+        store.set_tz(gettz('Europe/Paris'))
+        assert store.get(u'1').start == 1417906800
+        assert store.get(u'1').end - store.get(u'1').start == 86400
+
+    def test_event_without_times_is_skipped(self):
+        store = EventStore([{u'id': u'1', u'status': u'confirmed'}])
+        assert len(store) == 0
+
+    def test_remove_while_iterating(self):
+        store = EventStore(instances(4))
+        for event in store:
+            store.remove(event)
+        assert len(store) == 0
+
+    def test_expire_skips_replaced_events(self):
+        store = EventStore([[u'1', 100, 200], [u'2', 100, 200]])
+        store.upsert(Event(u'1', 100, 500))
+        store.discard(u'2')
+        assert store.expire(300) == []
+        assert store.expire(600) == [Event(u'1', 100, 500)]
+        assert len(store) == 0
+
+    def test_expire_all_day_events(self):
+        store = EventStore([{u'id': u'1', u'start': {u'date': u'2014-12-07'}, u'end': {u'date': u'2014-12-08'}},
+                            {u'id': u'2', u'start': {u'date': u'2114-12-07'}, u'end': {u'date': u'2114-12-08'}}])
+        assert [e.id for e in store.expire(time.time())] == [u'1']
+
+    def test_big_expiry_is_fast(self):
+        store = EventStore([u'{0}'.format(i), i, i + 10] for i in range(50000))
+        start = time.perf_counter()
+        assert len(store.expire(40000)) == 39990
+        assert time.perf_counter() - start < 1
+        assert len(store) == 10010
+
+    def test_on_change(self):
+        store = EventStore([[u'1', 100, 200]])
+        changes = []
+        store.on_change = lambda old, new: changes.append((old, new))
+        store.upsert(Event(u'1', 100, 200))
+        store.upsert(Event(u'2', 300, 400))
+        store.discard(u'1')
+        assert changes == [(None, Event(u'2', 300, 400)), (Event(u'1', 100, 200), None)]
+
+    def test_big_resync_is_fast(self):
+        store = EventStore(instances(5000))
+        start = time.perf_counter()
+        store.merge(instances(5000, summary=u'updated'))
+        assert time.perf_counter() - start < 1
+        assert len(store) == 5000
+
+
+if __name__ == "__main__":
+    unittest.main()
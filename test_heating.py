@@ -0,0 +1,430 @@
+""" test heating.py"""
+
+import datetime
+import io
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from googleapiclient.errors import HttpError
+
+import relay_backends
+import heating
+from heating import GCalAdapter, GCalCron, ZoneController, LOCAL_TZ
+
+
+class CountingRelays:
+    """a relay backend remembering the relay positions, counting reads and writes"""
+
+    def __init__(self):
+        self.positions = {}
+        self.reads = 0
+        self.writes = 0
+
+    def relay(self, position='not_defined', pin=1):
+        if position == 'not_defined':
+            self.reads += 1
+        else:
+            self.writes += 1
+            self.positions[pin] = int(position)
+        return self.positions.get(pin, 0)
+
+
+class BoardRelays(CountingRelays):
+    """a board switching its relays together, as ebe_relay does"""
+
+    def set_relays(self, positions):
+        self.writes += 1
+        self.positions.update(positions)
+        return dict(self.positions)
+
+    def read_relays(self):
+        self.reads += 1
+        return {pin: self.positions.get(pin, 0) for pin in (1, 2)}
+
+
+def register(test, name, backend):
+    """make backend the relay backend called name until the end of test"""
+    relay_backends.register(name, lambda: backend)
+    test.addCleanup(relay_backends._loaded.pop, name, None)
+    test.addCleanup(relay_backends.BACKENDS.pop, name, None)
+
+
+class StubService:
+    """
+  the calendar service, answering each events().list query with answer(query): a response, or an
+  exception to raise. Batches run their requests one after the other.
+  """
+
+    def __init__(self, answer):
+        self.answer = answer
+        self.queries = []
+        self.batches = 0
+
+    def events(self):
+        return self
+
+    def list(self, **query):
+        return StubRequest(self, query)
+
+    def new_batch_http_request(self):
+        return StubBatch(self)
+
+
+class StubRequest:
+
+    def __init__(self, service, query):
+        self.service = service
+        self.query = query
+
+    def execute(self):
+        self.service.queries.append(self.query)
+        response = self.service.answer(self.query)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+class StubBatch:
+
+    def __init__(self, service):
+        self.service = service
+        self.requests = []
+
+    def add(self, request, callback):
+        self.requests.append((request, callback))
+
+    def execute(self):
+        self.service.batches += 1
+        for request, callback in self.requests:
+            try:
+                response = request.execute()
+            except Exception as error:
+                callback(None, None, error)
+            else:
+                callback(None, response, None)
+
+
+class Response(dict):
+    """as httplib2's Response: the headers, and the status"""
+
+    def __init__(self, status):
+        super().__init__()
+        self.status = status
+        self.reason = ''
+
+
+def http_error(status):
+    return HttpError(Response(status), b'')
+
+
+def adapter(answer):
+    """a GCalAdapter for the StubService answering with answer, which does not wait to retry"""
+    a = GCalAdapter('a')
+    a.service = StubService(answer)
+    a.get_service = lambda: a.service
+    a.transport.sleep = lambda seconds: None
+    return a
+
+
+def event(id, start, end):
+    """a google calendar event from start to end seconds after NOW"""
+    return {'id': id, 'status': 'confirmed',
+            'start': {'dateTime': (NOW + datetime.timedelta(seconds=start)).isoformat()},
+            'end': {'dateTime': (NOW + datetime.timedelta(seconds=end)).isoformat()}}
+
+
+NOW = datetime.datetime(2014, 12, 7, 21, 0, tzinfo=LOCAL_TZ)
+T = NOW.timestamp()
+
+
+def cron(test, settings, backend):
+    """a GCalCron of settings, switching relays with backend until the end of test"""
+    register(test, 'counting', backend)
+    settings = dict(settings, relay_backend='counting')
+    return GCalCron(settings=io.StringIO(json.dumps(settings)))
+
+
+class HeatingTest(unittest.TestCase):
+    """tests for switching the relays
+    """
+
+    def test_writes_only_changes(self):
+        backend = CountingRelays()
+        g = cron(self, {'calendarId': 'a', 'relay_pin': 4, 'events': [['1', T, T + 600]], 'last_sync': None}, backend)
+        for minute in range(10):
+            g.evaluate(NOW + datetime.timedelta(minutes=minute))
+        assert (backend.reads, backend.writes) == (1, 1)
+        g.evaluate(NOW + datetime.timedelta(minutes=10))
+        assert backend.writes == 2
+        assert g.settings['relay_state'] == 0
+
+    def test_min_dwell(self):
+        backend = CountingRelays()
+        events = [['1', T, T + 60], ['2', T + 120, T + 600]]
+        g = cron(self, {'calendarId': 'a', 'relay_pin': 4, 'events': events, 'last_sync': None, 'min_dwell': 300}, backend)
+        g.evaluate(NOW)
+        g.evaluate(NOW + datetime.timedelta(seconds=60))
+        assert backend.positions[4] == 1  # not off for the minute between the events
+        assert g.next_transition(NOW + datetime.timedelta(seconds=60)) == NOW + datetime.timedelta(seconds=120)
+        g.evaluate(NOW + datetime.timedelta(seconds=600))
+        assert backend.positions[4] == 0
+        assert backend.writes == 1 + 1
+
+    def test_zones_on_a_board(self):
+        backend = BoardRelays()
+        register(self, 'board', backend)
+        settings = {'relay_backend': 'board', 'zones': [
+            {'calendarId': 'a', 'relay_pin': 1, 'events': [['1', T, T + 600]], 'last_sync': None},
+            {'calendarId': 'b', 'relay_pin': 2, 'events': [['2', T, T + 300]], 'last_sync': None}]}
+        c = ZoneController(None, settings)
+        c.save_settings = lambda force=False: None
+        c.refresh_relay(NOW)
+        c.refresh_relay(NOW + datetime.timedelta(seconds=60))
+        c.refresh_relay(NOW + datetime.timedelta(seconds=300))
+        assert (backend.reads, backend.writes) == (1, 2)
+        assert backend.positions == {1: 1, 2: 0}
+
+    def test_a_broken_board_leaves_the_other_zones_switched(self):
+        class BrokenBoard(BoardRelays):
+            def set_relays(self, positions):
+                raise IOError('board unplugged')
+        backend = BoardRelays()
+        register(self, 'board', backend)
+        register(self, 'broken', BrokenBoard())
+        settings = {'relay_backend': 'board', 'zones': [
+            {'calendarId': 'a', 'relay_pin': 1, 'relay_backend': 'broken', 'last_sync': None,
+             'events': [['old', T - 2 * 86400, T - 86400 - 3600], ['1', T, T + 600]]},
+            {'calendarId': 'b', 'relay_pin': 2, 'events': [['2', T, T + 600]], 'last_sync': None}]}
+        c = ZoneController(None, settings)
+        saves = []
+        c.save_settings = lambda force=False: saves.append(force)
+        with self.assertLogs('heating', 'ERROR'):
+            c.refresh_relay(NOW)
+        assert backend.positions == {2: 1}
+        assert [e.id for e in c.zones[0].settings['events']] == ['1']
+        assert saves == [False]
+
+    def test_relay_error_does_not_stop_the_run(self):
+        class BrokenRelays(CountingRelays):
+            def relay(self, position='not_defined', pin=1):
+                raise IOError('no relay broker')
+        g = cron(self, {'calendarId': 'a', 'relay_pin': 4, 'events': [['1', T, T + 600]], 'last_sync': None},
+                 BrokenRelays())
+        with self.assertLogs('heating', 'ERROR'):
+            heating.first_relay_decision(g)
+
+    def test_full_sync_replaces_saved_events(self):
+        g = cron(self, {'calendarId': 'a', 'relay_pin': 4, 'events': [['deleted', T, T + 600]], 'last_sync': None,
+                  'sync_mode': 'token', 'sync_token': 'EXPIRED'}, CountingRelays())
+        event = {'id': 'new', 'status': 'confirmed', 'start': {'dateTime': NOW.isoformat()},
+                 'end': {'dateTime': (NOW + datetime.timedelta(hours=1)).isoformat()}}
+        g.merge([event], NOW, 'NEW', full_sync=True)
+        assert [e.id for e in g.settings['events']] == ['new']
+        assert (g.settings['sync_token'], g.settings['sync_token_start']) == ('NEW', str(NOW))
+        assert g.timeline().active(T + 1800)
+
+    def test_recurring_events_expanded_days_ahead(self):
+        start = datetime.datetime.now(LOCAL_TZ).replace(hour=7, minute=0, second=0, microsecond=0)
+        daily = {'id': 'heat', 'status': 'confirmed', 'recurrence': ['RRULE:FREQ=DAILY'],
+                 'start': {'dateTime': start.isoformat()},
+                 'end': {'dateTime': (start + datetime.timedelta(hours=1)).isoformat()}}
+        in_13_days = (start + datetime.timedelta(days=13, minutes=1)).timestamp()
+        for days_ahead, active in ((7, False), (14, True)):
+            g = cron(self, {'calendarId': 'a', 'relay_pin': 4, 'events': [], 'last_sync': None,
+                            'recurrence': 'local', 'days_ahead': days_ahead}, CountingRelays())
+            g.merge([daily], NOW, None)
+            assert g.timeline().active(in_13_days) == active
+
+    def test_polls_only_when_due(self):
+        backend = CountingRelays()
+        g = cron(self, {'calendarId': 'a', 'relay_pin': 4, 'events': [], 'last_sync': None,
+                  'poll': {'min_interval': 60, 'max_interval': 1800}}, backend)
+        g.save_settings = lambda force=False: None
+        fetches = []
+        g.fetch = lambda num_days: fetches.append(num_days) or []
+        assert g.sync_gcal_to_cron()
+        assert not g.sync_gcal_to_cron()
+        assert len(fetches) == 1
+        g.settings['poll_state']['next'] = 0
+        assert g.sync_gcal_to_cron()
+        assert len(fetches) == 2
+
+    def test_google_api_is_imported_lazily(self):
+        loaded = subprocess.check_output([sys.executable, '-c', 'import sys, heating; '
+                                          'print(sorted(m for m in ("googleapiclient", "google_auth_oauthlib", '
+                                          '"httplib2", "gpiozero") if m in sys.modules))'])
+        assert loaded.strip() == b'[]'
+
+
+class SyncTest(unittest.TestCase):
+    """tests for fetching the events from google and merging them in
+    """
+
+    def test_get_changes_falls_back_to_a_full_sync(self):
+        a = adapter(lambda query: http_error(410) if 'syncToken' in query else
+                    {'items': [event('1', 0, 600)], 'nextSyncToken': 'NEW'})
+        entries, sync_token, full_sync = a.get_changes(NOW, 'EXPIRED')
+        assert ([e['id'] for e in entries], sync_token, full_sync) == (['1'], 'NEW', True)
+        assert [q.get('syncToken') for q in a.service.queries] == ['EXPIRED', None]
+
+    def test_batch_pages_retries_and_resyncs(self):
+        busy = []
+
+        def answer(query):
+            if query['calendarId'] == 'a':
+                if 'syncToken' in query:
+                    return http_error(410)
+                return {'items': [event('a1', 0, 600)], 'nextSyncToken': 'A'}
+            if not busy:
+                busy.append(query)
+                return http_error(503)
+            if 'pageToken' not in query:
+                return {'items': [event('b1', 0, 300)], 'nextPageToken': 'page 2'}
+            return {'items': [event('b2', 900, 1200)], 'nextSyncToken': 'B'}
+        a = adapter(answer)
+        results = a.get_zone_changes([('a', NOW, 'EXPIRED'), ('b', NOW, 'OLD')])
+        assert [([e['id'] for e in events], token, full) for events, token, full in results] == \
+            [(['a1'], 'A', True), (['b1', 'b2'], 'B', False)]
+        assert a.service.batches == 3
+
+    def test_service_is_built_once_from_the_cached_discovery_document(self):
+        cache = os.path.join(tempfile.mkdtemp(), 'discovery.json')
+        static = mock.Mock(return_value='{"name": "calendar"}')
+        with mock.patch.object(heating, 'DISCOVERY_CACHE', cache), mock.patch.object(heating, '_discovery_document'), \
+                mock.patch('googleapiclient.discovery_cache.get_static_doc', static):
+            heating._discovery_document = None
+            assert heating.discovery_document() == {'name': 'calendar'}
+            with open(cache) as f:
+                assert json.load(f) == {'name': 'calendar'}
+            heating._discovery_document = None  # a new process reads the cache
+            assert heating.discovery_document() == {'name': 'calendar'}
+            assert static.call_count == 1
+
+            def answer(query):
+                if 'pageToken' not in query:
+                    return {'items': [event('1', 0, 600)], 'nextPageToken': 'page 2'}
+                return {'items': [event('2', 900, 1200)], 'nextSyncToken': 'NEXT'}
+            service = StubService(answer)
+            a = GCalAdapter('a')
+            a.tokens.credentials = lambda: 'credentials'
+            with mock.patch('googleapiclient.discovery.build_from_document', return_value=service) as build:
+                a.get_zone_changes([('a', NOW, None), ('b', NOW, None)])
+                a.get_changes(NOW)
+            build.assert_called_once_with({'name': 'calendar'}, credentials='credentials')
+            assert len(service.queries) == 6
+
+    def test_batch_gives_up_on_a_zone(self):
+        a = adapter(lambda query: http_error(503) if query['calendarId'] == 'b' else {'items': [], 'nextSyncToken': 'A'})
+        results = a.get_zone_changes([('a', NOW, 'OLD'), ('b', NOW, 'OLD')])
+        assert results[0] == ([], 'A', False) and results[1] is None
+        assert a.service.batches == 1 + a.transport.retries
+        assert a.transport.breaker.state['failures'] == 0  # google is up, it answered zone a
+
+    def test_failed_batches_open_the_breaker(self):
+        c = ZoneController(None, {'zones': [{'calendarId': id, 'relay_pin': pin, 'events': [], 'last_sync': None}
+                                            for pin, id in enumerate('abcd')]},
+                           adapter(lambda query: http_error(503)))
+        # one failed sync of 4 zones counts once, the breaker opens after 3 of them
+        for failures in (1, 2, 3):
+            self.assertRaises(IOError, c.fetch)
+            assert c.gCalAdapter.transport.breaker.state['failures'] == failures
+        self.assertRaises(heating.CircuitOpenError, c.fetch)
+
+    def test_zone_controller_fetch_and_apply(self):
+        backend = BoardRelays()
+        register(self, 'board', backend)
+        settings = {'relay_backend': 'board', 'sync_mode': 'token', 'zones': [
+            {'calendarId': 'a', 'relay_pin': 1, 'events': [['gone', T, T + 600]], 'last_sync': None},
+            {'calendarId': 'b', 'relay_pin': 2, 'events': [], 'last_sync': None}]}
+        c = ZoneController(None, settings, adapter(lambda query: {
+            'items': [event(query['calendarId'] + '1', 0, 600)] if query['calendarId'] == 'b' else [],
+            'nextSyncToken': query['calendarId'].upper()}))
+        c.save_settings = lambda force=False: None
+        changes = c.fetch()
+        assert [(zone.getCalendarId(), token, full) for zone, events, start, token, full in changes] == \
+            [('a', 'A', True), ('b', 'B', True)]
+        c.apply(changes, NOW)
+        assert [e.id for e in c.zones[0].settings['events']] == []
+        assert [e.id for e in c.zones[1].settings['events']] == ['b1']
+        assert (backend.positions.get(1, 0), backend.positions[2]) == (0, 1)
+        assert c.zones[1].settings['sync_token'] == 'B'
+
+
+class DaemonTest(unittest.TestCase):
+    """tests for run_daemon
+    """
+
+    def setUp(self):
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            self.addCleanup(signal.signal, signum, signal.getsignal(signum))
+
+    def test_switches_at_transitions_and_stops(self):
+        backend = CountingRelays()
+        g = cron(self, {'calendarId': 'a', 'relay_pin': 4, 'events': [], 'last_sync': None}, backend)
+        g.gCalAdapter = GCalAdapter('a')
+        saved = []
+        g.save_settings = lambda force=False: saved.append(force)
+        fetches = []
+        on = int(time.time()) + 2  # events are in whole seconds
+
+        def fetch():
+            fetches.append(time.monotonic())
+            return [(g, [{'id': '1', 'status': 'confirmed',
+                          'start': {'dateTime': datetime.datetime.fromtimestamp(on, LOCAL_TZ).isoformat()},
+                          'end': {'dateTime': datetime.datetime.fromtimestamp(on + 1, LOCAL_TZ).isoformat()}}],
+                     datetime.datetime.now(LOCAL_TZ), None, False)]
+        g.fetch = fetch
+        switches = []
+        switched = g.switched
+        g.switched = lambda state, now: switches.append((time.time(), state)) or switched(state, now)
+
+        start = time.monotonic()
+        timer = threading.Timer(on + 2 - time.time(), os.kill, (os.getpid(), signal.SIGTERM))
+        timer.start()
+        self.addCleanup(timer.cancel)
+        heating.run_daemon(g, interval=60, evaluate_interval=60, sync_timeout=5)
+
+        assert len(fetches) == 1
+        assert [state for t, state in switches] == [1, 0]
+        assert [abs(t - expected) < 0.5 for (t, state), expected in zip(switches, (on, on + 1))] == [True, True]
+        assert backend.positions[4] == 0
+        assert saved[-1] is True
+        assert time.monotonic() - start < 5
+
+    def test_opens_push_channels_before_the_first_poll(self):
+        backend = CountingRelays()
+        g = cron(self, {'calendarId': 'a', 'relay_pin': 4, 'events': [], 'last_sync': None,
+                  'poll': {'max_interval': 1800}, 'poll_state': {'next': time.time() + 1800}}, backend)
+        g.gCalAdapter = GCalAdapter('a')
+        g.save_settings = lambda force=False: None
+        g.fetch = lambda: self.fail('polled before the scheduled time')
+        renewed = []
+
+        class Push:
+            def start(self):
+                pass
+
+            def stop(self):
+                pass
+
+            def renew(self, now):
+                renewed.append(now)
+                return now + datetime.timedelta(days=1)
+
+        timer = threading.Timer(0.5, os.kill, (os.getpid(), signal.SIGTERM))
+        timer.start()
+        self.addCleanup(timer.cancel)
+        heating.run_daemon(g, push=Push())
+        assert len(renewed) == 1
+
+
+if __name__ == "__main__":
+    unittest.main()
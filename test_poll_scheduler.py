@@ -0,0 +1,65 @@
+""" test poll_scheduler.py"""
+
+import datetime
+import doctest
+import unittest
+
+import poll_scheduler
+from poll_scheduler import PollScheduler
+
+NOW = datetime.datetime(2014, 12, 7, 6, 0, tzinfo=datetime.timezone.utc)
+
+
+class PollSchedulerTest(unittest.TestCase):
+    """tests for when to poll google calendar
+    """
+
+    def test_closer_to_a_transition_polls_more_often(self):
+        s = PollScheduler(60, 1800)
+        waits = [s.done(NOW, NOW + datetime.timedelta(minutes=minutes)) for minutes in (600, 20, 2)]
+        assert waits == [1800, 300, 60]
+
+    def test_backs_off_after_errors(self):
+        s = PollScheduler(60, 1800)
+        waits = [s.done(NOW, None, ok=False) for _ in range(6)]
+        for failures, wait in enumerate(waits, 1):
+            backoff = min(1800, 60 * 2 ** failures)
+            assert backoff / 2 <= wait <= backoff
+        assert s.done(NOW, None) == 1800
+        assert s.state['failures'] == 0
+
+    def test_daily_budget(self):
+        state = {}
+        s = PollScheduler(60, 1800, daily_budget=300, state=state)
+        evening = NOW.replace(hour=22)
+        assert s.done(evening, evening + datetime.timedelta(minutes=4)) == 60
+        state['count'] = 300
+        assert s.done(evening, evening + datetime.timedelta(minutes=4)) == 2 * 3600
+        assert s.due(evening.replace(hour=23, minute=59)) is False
+        assert s.due(NOW + datetime.timedelta(days=1))
+        s.done(NOW + datetime.timedelta(days=1))
+        assert state['count'] == 1
+
+    def test_budget_reserve_is_kept_for_transitions(self):
+        state = {}
+        s = PollScheduler(60, 1800, daily_budget=300, state=state)
+        state.update(day=NOW.date().toordinal(), count=250)
+        # quiet: wait for the run-up to the 11:00 transition, which starts 2 hours before it
+        assert s.done(NOW, NOW.replace(hour=11)) == 3 * 3600
+        assert s.done(NOW, None) == 18 * 3600
+        # in the run-up, the reserve is used
+        assert s.done(NOW, NOW + datetime.timedelta(minutes=4)) == 60
+
+    def test_from_settings(self):
+        assert PollScheduler.from_settings({}) is None
+        settings = {'poll': {'max_interval': 600}}
+        s = PollScheduler.from_settings(settings)
+        s.done(NOW)
+        assert settings['poll_state']['next'] == NOW.timestamp() + 600
+
+    def test_doctests(self):
+        assert doctest.testmod(poll_scheduler).failed == 0
+
+
+if __name__ == "__main__":
+    unittest.main()
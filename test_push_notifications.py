@@ -0,0 +1,83 @@
+""" test push_notifications.py"""
+
+import datetime
+import threading
+import time
+import unittest
+
+from push_notifications import PushNotifications, send_notification, CHANNEL_TTL, RENEW_BEFORE
+
+
+class FakeAdapter:
+    """stands in for GCalAdapter, recording the channels opened and closed"""
+
+    def __init__(self):
+        self.watched = []
+        self.stopped = []
+
+    def watch(self, channel_id, address, token, ttl, calendarId=None):
+        self.watched.append((channel_id, calendarId))
+        expiration = time.time() + ttl.total_seconds()
+        return {'id': channel_id, 'resourceId': 'resource-' + calendarId, 'expiration': str(int(expiration * 1000))}
+
+    def stop_watch(self, channel_id, resource_id):
+        self.stopped.append(channel_id)
+
+
+class PushNotificationsTest(unittest.TestCase):
+    """tests for the push notification receiver, with notifications from a fake sender
+    """
+
+    def setUp(self):
+        self.adapter = FakeAdapter()
+        self.changed = []
+        self.push = PushNotifications(self.adapter, 'https://example.org/notifications', ['a', 'b'],
+                                      on_change=self.changed.append, token='secret', host='localhost', port=0)
+        self.now = datetime.datetime.now(datetime.timezone.utc)
+        self.push.renew(self.now)
+        self.channel = {calendarId: channel_id for channel_id, calendarId in self.adapter.watched}
+
+    def test_renew_opens_one_channel_per_calendar(self):
+        assert sorted(self.channel) == ['a', 'b']
+        next_renewal = self.push.renew(self.now)
+        assert len(self.adapter.watched) == 2
+        assert abs(next_renewal - (self.now + CHANNEL_TTL - RENEW_BEFORE)) < datetime.timedelta(minutes=1)
+
+    def test_renew_replaces_expiring_channels(self):
+        self.push.renew(self.now + CHANNEL_TTL - RENEW_BEFORE / 2)
+        assert len(self.adapter.watched) == 4
+        assert sorted(self.adapter.stopped) == sorted(self.channel.values())
+        assert len(self.push.channels) == 2
+
+    def test_change_notification(self):
+        assert self.push.handle({'X-Goog-Channel-ID': self.channel['b'], 'X-Goog-Channel-Token': 'secret',
+                                 'X-Goog-Resource-State': 'exists'}) == 200
+        assert self.changed == ['b']
+
+    def test_sync_notification_is_not_a_change(self):
+        assert self.push.handle({'X-Goog-Channel-ID': self.channel['a'], 'X-Goog-Channel-Token': 'secret',
+                                 'X-Goog-Resource-State': 'sync'}) == 200
+        assert self.changed == []
+
+    def test_wrong_token_or_channel_is_ignored(self):
+        assert self.push.handle({'X-Goog-Channel-ID': self.channel['a'], 'X-Goog-Channel-Token': 'guess',
+                                 'X-Goog-Resource-State': 'exists'}) == 404
+        assert self.push.handle({'X-Goog-Channel-ID': 'unknown', 'X-Goog-Channel-Token': 'secret',
+                                 'X-Goog-Resource-State': 'exists'}) == 404
+        assert self.changed == []
+
+    def test_fake_sender_wakes_the_daemon(self):
+        notified = threading.Event()
+        self.push.on_change = lambda calendarId: notified.set()
+        self.push.start()
+        try:
+            url = 'http://localhost:{0}/notifications'.format(self.push.server.server_port)
+            assert send_notification(url, self.channel['a'], 'secret') == 200
+            assert notified.wait(5)
+        finally:
+            self.push.stop()
+        assert sorted(self.adapter.stopped) == sorted(self.channel.values())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+""" test recurrence.py"""
+
+import doctest
+import json
+import unittest
+
+from dateutil.tz import gettz
+
+import recurrence
+from event_store import Event, settings_default
+from recurrence import RecurringEvents
+
+DAY = 86400
+# 2014-12-01T07:00:00Z
+MONDAY = 1417417200
+
+
+def series(rule=u'RRULE:FREQ=DAILY', id=u'heat'):
+    return {u'id': id, u'status': u'confirmed', u'recurrence': [rule],
+            u'start': {u'dateTime': u'2014-12-01T07:00:00Z', u'timeZone': u'UTC'},
+            u'end': {u'dateTime': u'2014-12-01T09:00:00Z', u'timeZone': u'UTC'}}
+
+
+class RecurringEventsTest(unittest.TestCase):
+    """tests for the locally expanded recurring events
+    """
+
+    def test_doctests(self):
+        assert doctest.testmod(recurrence).failed == 0
+
+    def test_expand_window(self):
+        r = RecurringEvents()
+        r.upsert(series())
+        events = r.expand(MONDAY + 3 * DAY, MONDAY + 5 * DAY)
+        assert [e.start for e in events] == [MONDAY + 3 * DAY, MONDAY + 4 * DAY]
+
+    def test_moved_instance(self):
+        r = RecurringEvents()
+        r.upsert(series())
+        r.upsert({u'id': u'heat_20141202T070000Z', u'status': u'confirmed', u'recurringEventId': u'heat',
+                  u'originalStartTime': {u'dateTime': u'2014-12-02T07:00:00Z'},
+                  u'start': {u'dateTime': u'2014-12-02T10:00:00Z'}, u'end': {u'dateTime': u'2014-12-02T11:00:00Z'}})
+        events = r.expand(MONDAY + DAY - 3600, MONDAY + 2 * DAY - 3600)
+        assert events == [Event(u'heat_20141202T070000Z', MONDAY + DAY + 3 * 3600, MONDAY + DAY + 4 * 3600)]
+
+    def test_all_day_series_in_calendar_timezone(self):
+        r = RecurringEvents(tz=gettz('Europe/Paris'))
+        r.upsert({u'id': u'frost', u'status': u'confirmed', u'recurrence': [u'RRULE:FREQ=WEEKLY'],
+                  u'start': {u'date': u'2014-12-01'}, u'end': {u'date': u'2014-12-03'}})
+        events = r.expand(MONDAY + 7 * DAY, MONDAY + 8 * DAY)
+        # 2014-12-08 to 2014-12-10, midnight to midnight in Paris
+        assert events == [Event(u'frost_20141208', 1417993200, 1418166000, all_day=True)]
+        r.set_tz(gettz('UTC'))
+        assert r.expand(MONDAY + 7 * DAY, MONDAY + 8 * DAY)[0].start == 1417996800
+
+    def test_until_in_utc_or_floating(self):
+        r = RecurringEvents(tz=gettz('UTC'))
+        r.upsert({u'id': u'frost', u'status': u'confirmed', u'recurrence': [u'RRULE:FREQ=DAILY;UNTIL=20141205T000000Z'],
+                  u'start': {u'date': u'2014-12-01'}, u'end': {u'date': u'2014-12-02'}})
+        r.upsert(series(u'RRULE:FREQ=DAILY;UNTIL=20141203T070000'))
+        events = r.expand(MONDAY, MONDAY + 7 * DAY)
+        assert [e.id for e in events if not e.all_day] == [u'heat_20141201T070000Z', u'heat_20141202T070000Z',
+                                                          u'heat_20141203T070000Z']
+        assert [e.id for e in events if e.all_day][-1] == u'frost_20141205'
+
+    def test_not_recurring_event_is_left(self):
+        r = RecurringEvents()
+        assert not r.upsert({u'id': u'1', u'status': u'confirmed', u'start': {u'dateTime': u'2014-12-01T07:00:00Z'},
+                             u'end': {u'dateTime': u'2014-12-01T09:00:00Z'}})
+        assert len(r) == 0
+
+    def test_saved_and_loaded(self):
+        r = RecurringEvents()
+        r.upsert(series())
+        r.upsert({u'id': u'heat_20141202T070000Z', u'status': u'cancelled', u'recurringEventId': u'heat',
+                  u'originalStartTime': {u'dateTime': u'2014-12-02T07:00:00Z'}})
+        saved = RecurringEvents.from_json(json.loads(json.dumps(r, default=settings_default)))
+        window = (MONDAY, MONDAY + 3 * DAY)
+        assert saved.expand(*window) == r.expand(*window)
+
+    def test_prune_finished_series(self):
+        r = RecurringEvents()
+        r.upsert(series(u'RRULE:FREQ=DAILY;COUNT=2'))
+        r.upsert(series(id=u'forever'))
+        r.prune(MONDAY + 3 * DAY)
+        assert list(r.series) == [u'forever']
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+""" test relay_backends.py"""
+
+import unittest
+
+import relay_backends
+from relay_backends import get_backend
+
+
+class RelayBackendsTest(unittest.TestCase):
+    """tests for the relay backends
+    """
+
+    def test_mock_backend(self):
+        backend = get_backend('mock')
+        assert backend.relay(pin=4) == 0
+        assert backend.relay(position=1, pin=4) == 1
+        assert backend.relay(pin=4) == 1
+        assert backend.relay(position='open', pin=4) == 0
+        assert backend.device(4) is backend.device(4)
+        backend.close()
+        assert not backend.devices
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, get_backend, 'nope')
+
+    def test_register(self):
+        class Board:
+            def relay(self, position='not_defined', pin=1):
+                return 1
+        relay_backends.register('board', Board)
+        self.addCleanup(relay_backends._loaded.pop, 'board', None)
+        self.addCleanup(relay_backends.BACKENDS.pop, 'board', None)
+        assert get_backend('board') is get_backend('board')
+        assert get_backend('board').relay(pin=1) == 1
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+""" test relay_broker.py"""
+
+import os
+import socket
+import tempfile
+import threading
+import unittest
+
+from relay_backends import get_backend
+from relay_broker import RelayBroker, BrokerClient, RelayBrokerError
+
+
+class RelayBrokerTest(unittest.TestCase):
+    """tests for the relay broker and its client
+    """
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'relays.sock')
+        self.server = RelayBroker(self.path, get_backend('mock'))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def test_set_and_read(self):
+        client = BrokerClient(self.path)
+        assert client.relay(position=1, pin=17) == 1
+        assert BrokerClient(self.path).relay(pin=17) == 1
+        assert client.relay(position='open', pin=17) == 0
+        client.close()
+
+    def test_error(self):
+        client = BrokerClient(self.path)
+        self.assertRaises(RelayBrokerError, client.relay, position='sideways', pin=17)
+        assert client.relay(pin=17) in (0, 1)  # the connection is still usable
+        client.close()
+
+    def test_reconnects(self):
+        client = BrokerClient(self.path)
+        client.relay(pin=22)
+        client.sock.shutdown(socket.SHUT_RDWR)
+        assert client.relay(position=1, pin=22) == 1
+
+    def test_no_broker(self):
+        client = BrokerClient(self.path + '.missing')
+        self.assertRaises(RelayBrokerError, client.relay, pin=4)
+
+    def test_concurrent_clients(self):
+        clients = [BrokerClient(self.path) for _ in range(8)]
+        threads = [threading.Thread(target=lambda c=c: [c.relay(position=i % 2, pin=27) for i in range(50)])
+                   for c in clients]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert BrokerClient(self.path).relay(pin=27) in (0, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
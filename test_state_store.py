@@ -0,0 +1,109 @@
+""" test state_store.py"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import state_store
+from event_store import Event, EventStore
+from state_store import open_state, JsonState, SqliteState
+
+
+class StateStoreTest(unittest.TestCase):
+    """tests for the JSON and SQLite settings stores
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def settings(self):
+        return {'calendarId': 'a', 'relay_pin': 4, 'last_sync': None,
+                'events': EventStore([Event('1', 100, 200), Event('2', 300, 400)])}
+
+    def test_chosen_by_extension(self):
+        assert isinstance(open_state(os.path.join(self.dir, 'settings.json')), JsonState)
+        assert isinstance(open_state(os.path.join(self.dir, 'settings.db')), SqliteState)
+
+    def test_no_settings_yet(self):
+        assert open_state(os.path.join(self.dir, 'settings.json')).load() is None
+        assert open_state(os.path.join(self.dir, 'settings.db')).load() is None
+
+    def test_round_trip(self):
+        for name in ('settings.json', 'settings.db'):
+            state = open_state(os.path.join(self.dir, name))
+            state.save(self.settings())
+            loaded = open_state(os.path.join(self.dir, name)).load()
+            assert loaded['calendarId'] == 'a'
+            assert list(EventStore(loaded['events'])) == [Event('1', 100, 200), Event('2', 300, 400)]
+
+    def test_sqlite_writes_only_changes(self):
+        state = SqliteState(os.path.join(self.dir, 'settings.db'))
+        state.save(self.settings())
+        state = SqliteState(os.path.join(self.dir, 'settings.db'))
+        settings = state.load()
+        settings['events'].discard('1')
+        settings['events'].upsert(Event('3', 500, 600))
+        settings['last_sync'] = 'now'
+        changes_before = state.db.total_changes
+        state.save(settings)
+        # one deleted event, one new event, one setting and the time they were saved
+        assert state.db.total_changes - changes_before == 4
+        assert [e.id for e in SqliteState(state.settings_file).load()['events']] == ['2', '3']
+
+    def test_unchanged_settings_are_not_written(self):
+        for name in ('settings.json', 'settings.db'):
+            state = open_state(os.path.join(self.dir, name))
+            settings = self.settings()
+            assert state.save(settings)
+            assert not state.save(settings)
+            # only the sync position has moved on
+            settings['last_sync'] = 'now'
+            assert not state.save(settings)
+            assert state.save(settings, force=True)
+            settings['relay_state'] = 1
+            assert state.save(settings)
+
+    def test_sync_position_is_saved_across_runs(self):
+        for name in ('settings.json', 'settings.db'):
+            path = os.path.join(self.dir, name)
+            state = open_state(path)
+            assert state.save(self.settings())
+            state.close()
+            for run in range(3):
+                # a cron run a minute later: only the sync position moves on, and the write is put off
+                state = open_state(path)
+                settings = state.load()
+                settings['last_sync'] = 'run {0}'.format(run)
+                assert not state.save(settings)
+                state.close()
+            with mock.patch('time.time', return_value=time.time() + state_store.MAX_DEFER):
+                state = open_state(path)
+                settings = state.load()
+                assert not state.save(settings)  # nothing changed, so nothing is due either
+                settings['last_sync'] = 'later'
+                assert state.save(settings)
+                state.close()
+            assert open_state(path).load()['last_sync'] == 'later'
+
+    def test_json_write_is_atomic(self):
+        path = os.path.join(self.dir, 'settings.json')
+        JsonState(path).save(self.settings())
+        assert os.listdir(self.dir) == ['settings.json']
+
+    def test_sqlite_zones(self):
+        state = SqliteState(os.path.join(self.dir, 'settings.db'))
+        state.save({'sync_mode': 'token', 'zones': [self.settings(), dict(self.settings(), calendarId='b')]})
+        loaded = SqliteState(state.settings_file).load()
+        assert loaded['sync_mode'] == 'token'
+        assert [zone['calendarId'] for zone in loaded['zones']] == ['a', 'b']
+        assert len(loaded['zones'][1]['events']) == 2
+
+
+if __name__ == "__main__":
+    unittest.main()
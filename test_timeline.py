@@ -0,0 +1,66 @@
+""" test timeline.py"""
+
+import doctest
+import io
+import random
+import time
+import unittest
+
+import timeline
+from event_store import Event
+from dateutil.tz import gettz
+
+from timeline import Timeline
+
+
+class TimelineTest(unittest.TestCase):
+    """tests for the on/off timeline
+    """
+
+    def test_doctests(self):
+        assert doctest.testmod(timeline).failed == 0
+
+    def test_back_to_back_events_merge(self):
+        t = Timeline([(20, 30), (10, 20)])
+        assert t.intervals() == [(10, 30)]
+        assert t.next_change(15) == 30
+
+    def test_empty(self):
+        assert Timeline().next_change(0) is None
+        assert not Timeline().active(0)
+
+    def test_from_events(self):
+        t = Timeline.from_events([Event(u'1', 100, 200), Event(u'2', 86400, 3 * 86400, all_day=True)])
+        assert t.intervals() == [(100, 200), (86400, 3 * 86400)]
+        assert t.active(2 * 86400)
+
+    def test_add_matches_rebuild(self):
+        intervals = [(start, start + random.randint(1, 50)) for start in random.sample(range(1000), 200)]
+        t = Timeline()
+        for start, end in intervals:
+            t.add(start, end)
+        assert t.intervals() == Timeline(intervals).intervals()
+
+    def test_transitions(self):
+        t = Timeline([(10, 20), (40, 50)])
+        assert t.transitions(15, 45) == [(20, False), (40, True)]
+        assert t.transitions(50, 60) == [(50, False)]
+
+    def test_write_csv(self):
+        f = io.StringIO()
+        Timeline([(3600, 7200)]).write_csv(f, 0, 86400, gettz('UTC'), label=4)
+        assert f.getvalue().splitlines() == ['4,1970-01-01T00:00:00+00:00,off',
+                                             '4,1970-01-01T01:00:00+00:00,on',
+                                             '4,1970-01-01T02:00:00+00:00,off']
+
+    def test_queries_are_fast(self):
+        t = Timeline((i * 100, i * 100 + 50) for i in range(100000))
+        start = time.perf_counter()
+        for i in range(10000):
+            t.active(i * 997)
+            t.next_change(i * 997)
+        assert time.perf_counter() - start < 0.5
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+""" test token_manager.py"""
+
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from google.oauth2.credentials import Credentials
+
+from token_manager import TokenManager, _utcnow
+
+SCOPES = ['https://www.googleapis.com/auth/calendar.readonly']
+
+
+def token(access_token, expires_in):
+    return {'token': access_token, 'refresh_token': 'refresh', 'client_id': 'id', 'client_secret': 'secret',
+            'scopes': SCOPES, 'expiry': (_utcnow() + expires_in).isoformat() + 'Z'}
+
+
+class TokenManagerTest(unittest.TestCase):
+    """tests for sharing and refreshing the google credentials
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'token.json')
+        self.refreshes = []
+
+        def refresh(creds, request):
+            self.refreshes.append(creds.token)
+            creds.token = 'fresh'
+            creds.expiry = _utcnow() + datetime.timedelta(hours=1)
+        patcher = mock.patch.object(Credentials, 'refresh', refresh)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, content):
+        with open(self.path, 'w') as f:
+            json.dump(content, f)
+
+    def test_valid_token_is_not_refreshed(self):
+        self.write(token('current', datetime.timedelta(minutes=30)))
+        tokens = TokenManager(self.path, SCOPES)
+        assert tokens.credentials().token == 'current'
+        assert tokens.credentials() is tokens.credentials()
+        assert self.refreshes == []
+
+    def test_refreshes_ahead_of_expiry(self):
+        self.write(token('old', datetime.timedelta(minutes=5)))
+        tokens = TokenManager(self.path, SCOPES)
+        assert tokens.credentials().token == 'fresh'
+        with open(self.path) as f:
+            assert json.load(f)['token'] == 'fresh'
+
+    def test_one_process_refreshes(self):
+        self.write(token('old', datetime.timedelta(hours=1)))
+        first, second = TokenManager(self.path, SCOPES), TokenManager(self.path, SCOPES)
+        creds = second.credentials()
+        self.write(token('old', datetime.timedelta(minutes=5)))
+        os.utime(self.path, ns=(1, 1))  # sure to be seen as changed
+        assert first.credentials().token == 'fresh'
+        assert second.credentials() is creds and creds.token == 'fresh'
+        assert self.refreshes == ['old']
+
+    def test_moves_old_token_file(self):
+        old_path = os.path.join(self.dir, 'old_token.json')
+        with open(old_path, 'w') as f:
+            json.dump(token('current', datetime.timedelta(hours=1)), f)
+        assert TokenManager(self.path, SCOPES, old_path=old_path).credentials().token == 'current'
+        assert os.path.exists(self.path)
+
+
+if __name__ == "__main__":
+    unittest.main()
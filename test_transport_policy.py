@@ -0,0 +1,91 @@
+""" test transport_policy.py"""
+
+import doctest
+import unittest
+
+import transport_policy
+from transport_policy import CircuitBreaker, CircuitOpenError, TransportPolicy
+
+
+class Response(dict):
+    """as httplib2's Response: the headers, and the status"""
+
+
+class HttpError(Exception):
+    """as googleapiclient's HttpError"""
+
+    def __init__(self, resp, content=b''):
+        super().__init__(resp.status)
+        self.resp = resp
+        self.content = content
+
+
+def error(status, headers=None, content=b''):
+    resp = Response(headers or {})
+    resp.status = status
+    return HttpError(resp, content)
+
+
+class Request:
+    """a request answering with each of outcomes in turn, raising those that are exceptions"""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def execute(self):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+def policy(**kwargs):
+    p = TransportPolicy(breaker=CircuitBreaker(state={}), **kwargs)
+    p.slept = []
+    p.sleep = p.slept.append
+    return p
+
+
+class TransportPolicyTest(unittest.TestCase):
+    """tests for retrying requests and the circuit breaker
+    """
+
+    def test_retries_transient_errors(self):
+        p = policy()
+        request = Request(error(503), TimeoutError(), error(403, content=b'"reason": "rateLimitExceeded"'), {'items': []})
+        assert p.execute(request) == {'items': []}
+        assert request.calls == 4 and len(p.slept) == 3
+
+    def test_honours_retry_after(self):
+        p = policy()
+        assert p.execute(Request(error(429, {'retry-after': '7'}), 'ok')) == 'ok'
+        assert p.slept == [7.0]
+        request = Request(error(429, {'retry-after': '3600'}))
+        self.assertRaises(HttpError, p.execute, request)
+        assert request.calls == 1
+
+    def test_other_errors_are_not_retried(self):
+        p = policy()
+        request = Request(error(410), 'ok')
+        self.assertRaises(HttpError, p.execute, request)
+        assert request.calls == 1 and p.breaker.state['failures'] == 0
+
+    def test_gives_up_and_opens_the_breaker(self):
+        p = policy(retries=1)
+        for _ in range(transport_policy.BREAKER_FAILURES):
+            self.assertRaises(HttpError, p.execute, Request(error(500), error(502)))
+        request = Request('ok')
+        self.assertRaises(CircuitOpenError, p.execute, request)
+        assert request.calls == 0
+        p.breaker.state['opened'] -= transport_policy.BREAKER_RESET
+        assert p.execute(request) == 'ok'
+        assert p.breaker.state == {'failures': 0, 'opened': 0}
+
+    def test_doctests(self):
+        assert doctest.testmod(transport_policy).failed == 0
+
+
+if __name__ == "__main__":
+    unittest.main()
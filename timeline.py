@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""When the relay should be on, as a sorted list of merged on/off intervals.
+
+Deciding whether the relay should be on used to mean parsing and checking every saved event on
+every run. The timeline is built once from the events whenever they change, merging overlapping
+and back to back events, so "is any event on now?" and "when does that next change?" are a binary
+search. Times are seconds since the epoch; all-day events are on from the midnight starting their
+first day to the one ending their last, as the event store has already worked out.
+
+New events are added to the timeline in place, so a sync that only brings new bookings does not
+rebuild it. The timeline also answers what the relay will do between two times, and writes that
+plan out as CSV.
+"""
+
+import bisect
+import csv
+import datetime
+
+
+class Timeline:
+    """
+  Merged, sorted, non-overlapping [start, end) intervals during which the relay should be on.
+
+  >>> t = Timeline([(10, 20), (15, 30), (40, 50)])
+  >>> t.intervals()
+  [(10, 30), (40, 50)]
+  >>> t.active(5), t.active(10), t.active(29), t.active(30)
+  (False, True, True, False)
+  >>> t.next_change(5), t.next_change(25), t.next_change(35), t.next_change(50)
+  (10, 30, 40, None)
+  >>> t.add(28, 42)
+  >>> t.intervals()
+  [(10, 50)]
+  >>> t.transitions(0, 50)
+  [(10, True)]
+  """
+
+    def __init__(self, intervals=()):
+        self.starts = []
+        self.ends = []
+        for start, end in sorted(i for i in intervals if i[0] < i[1]):
+            if self.ends and start <= self.ends[-1]:
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    @classmethod
+    def from_events(cls, events):
+        """build the timeline from the Events of an EventStore"""
+        return cls((event.start, event.end) for event in events)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def intervals(self):
+        return list(zip(self.starts, self.ends))
+
+    def add(self, start, end):
+        """add the interval [start, end), merging it with those it overlaps or touches"""
+        if start >= end:
+            return
+        i = bisect.bisect_left(self.ends, start)  # the first interval ending at or after start
+        j = bisect.bisect_right(self.starts, end)  # after the last interval starting at or before end
+        if i < j:
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j - 1])
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+
+    def active(self, t):
+        """True if the relay should be on at time t"""
+        i = bisect.bisect_right(self.starts, t) - 1
+        return i >= 0 and t < self.ends[i]
+
+    def next_change(self, t):
+        """the first time after t at which the relay should change position, or None if it never does"""
+        i = bisect.bisect_right(self.starts, t) - 1
+        if i >= 0 and t < self.ends[i]:
+            return self.ends[i]
+        if i + 1 < len(self.starts):
+            return self.starts[i + 1]
+        return None
+
+    def transitions(self, start, end):
+        """the (time, on) changes of the relay from start to end, with on True when it switches on"""
+        ons = self.starts[bisect.bisect_left(self.starts, start):bisect.bisect_left(self.starts, end)]
+        offs = self.ends[bisect.bisect_left(self.ends, start):bisect.bisect_left(self.ends, end)]
+        return sorted([(t, True) for t in ons] + [(t, False) for t in offs])
+
+    def write_csv(self, f, start, end, tz=None, label=None):
+        """
+    write the relay's position at start and its changes up to end to file f as CSV rows of
+    time, on/off (preceded by label if given), the times as datetimes in timezone tz
+    """
+        writer = csv.writer(f)
+        prefix = [] if label is None else [label]
+        writer.writerow(prefix + [to_datetime(start, tz).isoformat(), 'on' if self.active(start) else 'off'])
+        for t, on in self.transitions(start, end):
+            if t > start:
+                writer.writerow(prefix + [to_datetime(t, tz).isoformat(), 'on' if on else 'off'])
+
+
+def to_datetime(t, tz):
+    """a time from the timeline as a datetime in timezone tz, None stays None"""
+    if t is None:
+        return None
+    return datetime.datetime.fromtimestamp(t, tz)
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""The google OAuth credentials, shared by all the heating.py processes of a machine.
+
+They are kept in one token file (--token_file, by default token.json next to heating.py rather
+than in whatever directory a run starts in). A process reads the file once and keeps the
+credentials in memory, reading it again only when another process has refreshed them. They are
+refreshed REFRESH_AHEAD of expiry, so no request goes out with a token about to run out, by one
+process at a time: the others wait on the lock file (the token file + '.lock') and then find the
+token already refreshed. Credentials are only ever loaded and refreshed to sync, after the relays
+have been switched from the saved events, or on the daemon's sync thread.
+"""
+
+import contextlib
+import datetime
+import fcntl
+import logging
+import os
+import threading
+
+from state_store import write_atomic
+
+logger = logging.getLogger(__name__)
+
+REFRESH_AHEAD = datetime.timedelta(minutes=10)
+
+
+def _utcnow():
+    """now, as the naive UTC datetime google auth uses for the expiry of credentials"""
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+class TokenManager:
+    """
+  The credentials in the token file at path, for scopes. A token file at old_path (where they
+  used to be kept) is moved to path on first use.
+  """
+
+    def __init__(self, path, scopes, old_path=None, refresh_ahead=REFRESH_AHEAD):
+        self.path = path
+        self.scopes = scopes
+        self.old_path = old_path
+        self.refresh_ahead = refresh_ahead
+        self.creds = None
+        self._mtime = None  # of the token file when it was last read or written
+        self._lock = threading.Lock()  # the push notifications and syncs of the daemon share the credentials
+
+    def credentials(self):
+        """the credentials, refreshed if due, or None if there are none or only logging in again can renew them"""
+        with self._lock:
+            self._load()
+            if self.creds is None:
+                return None
+            if self.due():
+                if not self.creds.refresh_token:
+                    return None
+                with self._file_lock():
+                    self._load()  # another process may have refreshed them meanwhile
+                    if self.due():
+                        from google.auth.transport.requests import Request
+                        logger.info('refreshing the google credentials')
+                        self.creds.refresh(Request())
+                        self._write()
+            return self.creds
+
+    def save(self, creds):
+        """keep the credentials of a new login"""
+        with self._lock, self._file_lock():
+            self.creds = creds
+            self._write()
+
+    def due(self, now=None):
+        """True if the credentials have no token, or it expires within refresh_ahead"""
+        if self.creds is None or not self.creds.token:
+            return True
+        if self.creds.expiry is None:
+            return False
+        return self.creds.expiry - (now or _utcnow()) < self.refresh_ahead
+
+    def _load(self):
+        """read the token file if it has changed since it was last read or written"""
+        path = self.path
+        if not os.path.exists(path):
+            if self.creds is not None or not self.old_path or not os.path.exists(self.old_path):
+                return
+            logger.info('moving {0} to {1}'.format(self.old_path, self.path))
+            path = self.old_path
+        mtime = os.stat(path).st_mtime_ns
+        if path == self.path and mtime == self._mtime:
+            return
+        from google.oauth2.credentials import Credentials
+        creds = Credentials.from_authorized_user_file(path, self.scopes)
+        if self.creds is None:
+            self.creds = creds
+        else:
+            # in place, as the calendar service is built with these credentials
+            self.creds.token = creds.token
+            self.creds.expiry = creds.expiry
+        if path == self.path:
+            self._mtime = mtime
+        else:
+            self._write()
+
+    def _write(self):
+        write_atomic(self.path, self.creds.to_json())
+        os.chmod(self.path, 0o600)
+        self._mtime = os.stat(self.path).st_mtime_ns
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        """hold the lock file, for one process at a time to refresh or write the credentials"""
+        with open(self.path + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
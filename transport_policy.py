@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""How requests to google calendar are made: retried, and not made at all while google is down.
+
+Each request gives up after the adapter's timeout (--sync_timeout). A request that fails with a
+rate limit (429, or 403 rateLimitExceeded), a server error (5xx) or a network error is retried up
+to RETRIES times, after the Retry-After google sends or an exponential backoff with jitter. Other
+errors, such as the 410 of an expired sync token, are google answering and are raised at once.
+
+After BREAKER_FAILURES requests in a row failed for good, the circuit breaker opens: for
+BREAKER_RESET seconds no request is sent and CircuitOpenError is raised straight away, then one
+sync tries again. The relays keep being switched from the saved events all along. The breaker's
+state is kept in the settings ("circuit_state"), so it holds across cron runs, and can be tuned with
+  "circuit_breaker": {"failures": 3, "reset_after": 300}
+"""
+
+import datetime
+import email.utils
+import logging
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+RETRIES = 3
+RETRY_DELAY = 1  # seconds before the first retry, doubling after that
+MAX_RETRY_DELAY = 60  # a longer Retry-After is not waited for
+BREAKER_FAILURES = 3
+BREAKER_RESET = 300
+
+TRANSIENT_STATUSES = (429, 500, 502, 503, 504)
+
+
+class CircuitOpenError(IOError):
+    """google calendar is down, so the request was not sent"""
+
+
+def http_status(error):
+    """HTTP status of a googleapiclient HttpError, or None for any other exception"""
+    resp = getattr(error, 'resp', None)
+    return getattr(resp, 'status', None)
+
+
+def is_transient(error):
+    """True if a request that failed with error is worth trying again"""
+    status = http_status(error)
+    if status is not None:
+        if status == 403:
+            # google's rateLimitExceeded and userRateLimitExceeded
+            return b'ateLimitExceeded' in (getattr(error, 'content', None) or b'')
+        return status in TRANSIENT_STATUSES
+    if isinstance(error, OSError):  # refused, reset, timed out
+        return True
+    import httplib2
+    return isinstance(error, httplib2.HttpLib2Error)  # e.g. ServerNotFoundError
+
+
+def retry_after(error, now=None):
+    """
+  seconds the Retry-After header of an HttpError asks to wait, or None
+
+  >>> class Error(Exception): resp = {'retry-after': '30'}
+  >>> retry_after(Error())
+  30.0
+  """
+    value = (getattr(error, 'resp', None) or {}).get('retry-after')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    return max((when - now).total_seconds(), 0)
+
+
+class CircuitBreaker:
+    """
+  Counts the requests that failed in a row, in the dict state. Once there are `failures` of them,
+  no request is allowed for `reset_after` seconds, then one is let through to see if google is back.
+
+  >>> b = CircuitBreaker(failures=2, reset_after=300, state={})
+  >>> b.failed(1000), b.failed(1001), b.allow(1100), b.allow(1301)
+  (False, True, False, True)
+  >>> b.succeeded(); b.allow(1302)
+  True
+  """
+
+    def __init__(self, failures=BREAKER_FAILURES, reset_after=BREAKER_RESET, state=None):
+        self.failures = failures
+        self.reset_after = reset_after
+        self.state = state if state is not None else {}
+        # set up front, so the daemon's sync thread only ever replaces values while the settings are being saved
+        for key in ('failures', 'opened'):
+            self.state.setdefault(key, 0)
+
+    @classmethod
+    def from_settings(cls, settings):
+        """the breaker the "circuit_breaker" settings ask for, keeping its state in the settings"""
+        config = settings.get('circuit_breaker') or {}
+        return cls(config.get('failures', BREAKER_FAILURES), config.get('reset_after', BREAKER_RESET),
+                   settings.setdefault('circuit_state', {}))
+
+    def allow(self, now=None):
+        """True unless the breaker is open"""
+        if self.state['failures'] < self.failures:
+            return True
+        return (now or time.time()) >= self.state['opened'] + self.reset_after
+
+    def reopens_at(self):
+        """seconds since the epoch at which a request is next allowed"""
+        return self.state['opened'] + self.reset_after
+
+    def succeeded(self):
+        self.state['failures'] = 0
+        self.state['opened'] = 0
+
+    def failed(self, now=None):
+        """count a failed request, returning True if that opened the breaker"""
+        self.state['failures'] += 1
+        if self.state['failures'] >= self.failures:
+            self.state['opened'] = int(now or time.time())
+            if self.state['failures'] == self.failures:
+                logger.warning('google calendar is down, not trying again for {0}s'.format(self.reset_after))
+            return True
+        return False
+
+
+class TransportPolicy:
+    """
+  Sends the requests of the google api client (anything with an execute()), retrying the transient
+  failures and going through the CircuitBreaker.
+  """
+
+    def __init__(self, retries=RETRIES, breaker=None):
+        self.retries = retries
+        self.breaker = breaker or CircuitBreaker()
+        self.sleep = time.sleep
+
+    def check(self):
+        """raise CircuitOpenError if no request may be sent"""
+        if not self.breaker.allow():
+            raise CircuitOpenError('google calendar is down, next try at {0}'.format(
+                datetime.datetime.fromtimestamp(self.breaker.reopens_at()).strftime('%H:%M:%S')))
+
+    def delay(self, attempt, error=None):
+        """
+    seconds to wait before retry number attempt (from 0), as the error's Retry-After asks or backing
+    off exponentially with jitter, or None if that is more than MAX_RETRY_DELAY
+    """
+        wait = retry_after(error) if error is not None else None
+        if wait is None:
+            wait = random.uniform(0.5, 1) * RETRY_DELAY * 2 ** attempt
+        return wait if wait <= MAX_RETRY_DELAY else None
+
+    def execute(self, request, batch=False):
+        """
+    the response to request, retried as needed. Raises the last error, or CircuitOpenError. The queries
+    of a batch request succeed or fail one by one, so its caller tells the breaker how they went.
+    """
+        self.check()
+        attempt = 0
+        while True:
+            try:
+                response = request.execute()
+            except Exception as error:
+                if not is_transient(error):
+                    if http_status(error) is not None:
+                        self.breaker.succeeded()  # google is up, it answered
+                    raise
+                wait = self.delay(attempt, error) if attempt < self.retries else None
+                if wait is None:
+                    self.breaker.failed()
+                    raise
+                logger.warning('request failed ({0}), retrying in {1:.1f}s'.format(
+                    http_status(error) or error, wait))
+                self.sleep(wait)
+                attempt += 1
+                continue
+            if not batch:
+                self.breaker.succeeded()
+            return response